@@ -0,0 +1,237 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Run the pada benchmark scenarios, and write the results as JSON.
+
+Usage::
+
+    python -m benchmarks.run --frames 200 --width 1600 --height 1200 \
+                             --output results.json
+
+Each scenario runs in a fresh process so that its peak RSS can be measured.
+The synthetic dataset is generated once in the work directory, and reused by
+later runs with the same parameters.
+
+"""
+
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy
+
+import pada.align
+import pada.framedrop
+from pada import features
+
+from . import stub
+from . import synthetic
+
+
+def _dataset(args):
+    data_dir = os.path.join(args.work_dir, "input-{}x{}-{}-{}".format(
+                                 args.width, args.height, args.frames,
+                                 args.seed))
+    if not os.path.exists(os.path.join(data_dir, 'truth.json')):
+        synthetic.make_sequence(data_dir, args.frames, args.width,
+                                args.height, seed=args.seed)
+    names = sorted(glob.glob(os.path.join(data_dir, '*.jpg')))
+    return names, stub.StubLandmarkFinder(os.path.join(data_dir,
+                                                       'truth.json'))
+
+
+def _aligned(args, names, finder):
+    out_path = "{}-aligned".format(os.path.dirname(names[0]))
+    if not os.path.exists(os.path.join(out_path,
+                                       pada.align.MANIFEST_NAME)):
+        pada.align.align_images(names, out_path, 'jpg', finder)
+    return sorted(glob.glob(os.path.join(out_path, '*.jpg')))
+
+
+def bench_read_ims(args, names, finder):
+    for _ in pada.align.read_ims(names, 0.0):
+        pass
+    return len(names)
+
+
+def bench_orthogonal_procrustes(args, names, finder):
+    rng = numpy.random.RandomState(0)
+    ref = numpy.matrix(rng.uniform(0, 1000, (68, 2)))
+    count = 10000
+    for _ in range(count):
+        pada.align.orthogonal_procrustes(
+                       ref, ref + numpy.matrix(rng.normal(0, 5, (68, 2))))
+    return count
+
+
+def bench_warp_im(args, names, finder):
+    im = cv2.imread(names[0])
+    M = numpy.matrix([[0.99, 0.02, 5.],
+                      [-0.02, 0.99, -3.],
+                      [0., 0., 1.]])
+    count = 50
+    buf = None
+    for _ in range(count):
+        buf = pada.align.warp_im(im, M, im.shape, out=buf)
+    return count
+
+
+def bench_align_images(args, names, finder):
+    out_path = os.path.join(args.work_dir, 'bench-aligned')
+    pada.align.align_images(names, out_path, 'jpg', finder, jobs=args.jobs)
+    shutil.rmtree(out_path)
+    return len(names)
+
+
+def bench_find_weights(args, names, finder):
+    aligned = _aligned(args, names, finder)
+    mask = pada.framedrop.make_mask(aligned[0], args.erode_amount, finder)
+    vecs = list(features.read_features(aligned, mask))
+
+    start = time.time()
+    pada.framedrop.find_weights(vecs, args.frame_skip)
+    return len(aligned), time.time() - start
+
+
+def bench_filter_files(args, names, finder):
+    aligned = _aligned(args, names, finder)
+    list(pada.framedrop.filter_files(aligned, args.frame_skip,
+                                     args.erode_amount, finder))
+    return len(aligned)
+
+
+SCENARIOS = (
+    ('read_ims', bench_read_ims),
+    ('orthogonal_procrustes', bench_orthogonal_procrustes),
+    ('warp_im', bench_warp_im),
+    ('align_images', bench_align_images),
+    ('find_weights', bench_find_weights),
+    ('filter_files', bench_filter_files),
+)
+
+
+def _run_scenario(func, args, queue):
+    names, finder = _dataset(args)
+    start = time.time()
+    result = func(args, names, finder)
+    elapsed = time.time() - start
+    if isinstance(result, tuple):
+        # The scenario timed only part of its own run.
+        count, elapsed = result
+    else:
+        count = result
+    queue.put({
+        'items': count,
+        'seconds': elapsed,
+        'items_per_s': count / elapsed if elapsed > 0 else None,
+        'peak_rss_mb': pada.align._peak_rss_mb(),
+    })
+
+
+def _git_revision():
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return rev.strip().decode('ascii')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', help='Number of input frames', type=int,
+                        default=100)
+    parser.add_argument('--width', help='Input frame width', type=int,
+                        default=1600)
+    parser.add_argument('--height', help='Input frame height', type=int,
+                        default=1200)
+    parser.add_argument('--seed', help='Random seed for the dataset',
+                        type=int, default=0)
+    parser.add_argument('--jobs', help='Worker processes for align',
+                        type=int, default=1)
+    parser.add_argument('--frame-skip', help='framedrop frame skip',
+                        type=int, default=10)
+    parser.add_argument('--erode-amount', help='framedrop erode amount',
+                        type=int, default=51)
+    parser.add_argument('--work-dir',
+                        help='Directory for the dataset and intermediate '
+                             'files')
+    parser.add_argument('--output', help='JSON file to write results to')
+    parser.add_argument('scenarios', nargs='*',
+                        help='Scenarios to run (default all)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    remove_work_dir = args.work_dir is None
+    if remove_work_dir:
+        args.work_dir = tempfile.mkdtemp(prefix='pada-bench-')
+
+    try:
+        # Generate the dataset up front, so that it is not timed.
+        _dataset(args)
+
+        results = {}
+        for name, func in SCENARIOS:
+            if args.scenarios and name not in args.scenarios:
+                continue
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=_run_scenario,
+                                        args=(func, args, queue))
+            p.start()
+            results[name] = queue.get()
+            p.join()
+            sys.stderr.write(
+                "{}: {:.3f} s, {:.1f} items/s, {:.0f} MB\n".format(
+                    name, results[name]['seconds'],
+                    results[name]['items_per_s'] or 0.,
+                    results[name]['peak_rss_mb']))
+    finally:
+        if remove_work_dir:
+            shutil.rmtree(args.work_dir)
+
+    report = {
+        'revision': _git_revision(),
+        'params': {k: v for k, v in vars(args).items()
+                       if k not in ('output', 'work_dir', 'scenarios')},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
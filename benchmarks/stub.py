@@ -0,0 +1,77 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+__all__ = (
+    'StubLandmarkFinder',
+)
+
+
+import collections
+import json
+import os
+
+import numpy
+
+from pada import landmarks
+
+from . import synthetic
+
+
+class StubLandmarkFinder(object):
+    """
+    Drop-in replacement for :class:`pada.landmarks.LandmarkFinder` which
+    returns the known landmarks of frames made by
+    :func:`.synthetic.make_sequence`, without needing dlib or a predictor
+    file.
+
+    Images without a valid marker (such as aligned frames, whose marker has
+    been warped away) are given the landmarks of the first frame with a face.
+
+    """
+    def __init__(self, truth_path):
+        self.truth_path = truth_path
+        with open(truth_path) as f:
+            self._truth = {int(k): numpy.matrix(v)
+                               for k, v in json.load(f).items()}
+        self._default = self._truth[min(self._truth)]
+        self.stats = collections.Counter()
+
+    def get_settings(self):
+        return {'predictor_path': os.path.abspath(self.truth_path)}
+
+    def log_stats(self, stats=None):
+        pass
+
+    def reset_tracking(self):
+        pass
+
+    def get(self, im):
+        marker = synthetic.decode_marker(im)
+        if marker is None:
+            self.stats['unmarked'] += 1
+            return self._default
+
+        frame_id, kind = marker
+        if kind == synthetic.NO_FACES:
+            raise landmarks.NoFaces
+        if kind == synthetic.TOO_MANY_FACES:
+            raise landmarks.TooManyFaces
+        return self._truth[frame_id]
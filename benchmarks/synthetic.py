@@ -0,0 +1,209 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Generate synthetic photo-a-day sequences for benchmarking.
+
+Each frame contains a simple drawn face whose 68 landmarks are known exactly.
+The landmarks are not recovered from the pixels. Instead each frame carries a
+row of black and white blocks in its top left corner encoding a frame number,
+which :class:`.StubLandmarkFinder` reads back to look up the landmarks.
+
+"""
+
+
+__all__ = (
+    'FACE',
+    'NO_FACES',
+    'TOO_MANY_FACES',
+    'decode_marker',
+    'make_sequence',
+)
+
+
+import json
+import math
+import os
+import shutil
+
+import cv2
+import numpy
+
+
+FACE = 0
+NO_FACES = 1
+TOO_MANY_FACES = 2
+
+_ID_BITS = 16
+_KIND_BITS = 2
+_CHECK_BITS = 6
+_MARKER_BITS = _ID_BITS + _KIND_BITS + _CHECK_BITS
+
+
+def _template():
+    """
+    Return a 68 point face template in the dlib ordering, in units of the face
+    half-width and centred on the nose.
+
+    """
+    pts = []
+    # Jaw.
+    for t in numpy.linspace(math.pi, 2 * math.pi, 17):
+        pts.append((math.cos(t), -1.2 * math.sin(t) - 0.2))
+    # Eyebrows.
+    for cx in (-0.45, 0.45):
+        for t in numpy.linspace(-0.3, 0.3, 5):
+            pts.append((cx + t, -0.75 + 0.3 * t * t))
+    # Nose bridge and base.
+    for y in numpy.linspace(-0.45, -0.05, 4):
+        pts.append((0., y))
+    for x in numpy.linspace(-0.2, 0.2, 5):
+        pts.append((x, 0.1))
+    # Eyes.
+    for cx in (-0.4, 0.4):
+        for t in numpy.linspace(0, 2 * math.pi, 7)[:-1]:
+            pts.append((cx + 0.18 * math.cos(t), -0.45 + 0.08 * math.sin(t)))
+    # Outer and inner lips.
+    for t in numpy.linspace(0, 2 * math.pi, 13)[:-1]:
+        pts.append((0.4 * math.cos(t), 0.5 + 0.15 * math.sin(t)))
+    for t in numpy.linspace(0, 2 * math.pi, 9)[:-1]:
+        pts.append((0.25 * math.cos(t), 0.5 + 0.06 * math.sin(t)))
+    assert len(pts) == 68
+    return numpy.array(pts)
+
+
+def _block_size(shape):
+    return max(4, min(shape[0], shape[1]) // 100)
+
+
+def _draw_marker(im, frame_id, kind):
+    check = (frame_id + kind) % (1 << _CHECK_BITS)
+    word = ((frame_id << (_KIND_BITS + _CHECK_BITS)) |
+            (kind << _CHECK_BITS) |
+            check)
+    b = _block_size(im.shape)
+    for i in range(_MARKER_BITS):
+        bit = (word >> (_MARKER_BITS - 1 - i)) & 1
+        im[0:b, i * b:(i + 1) * b] = 255 * bit
+
+
+def decode_marker(im):
+    """
+    Return `(frame_id, kind)` encoded in the image's marker, or `None` if
+    there is no valid marker.
+
+    """
+    b = _block_size(im.shape)
+    if _MARKER_BITS * b > im.shape[1]:
+        return None
+    word = 0
+    for i in range(_MARKER_BITS):
+        word = (word << 1) | int(im[b // 2, i * b + b // 2].mean() > 127)
+    check = word & ((1 << _CHECK_BITS) - 1)
+    kind = (word >> _CHECK_BITS) & ((1 << _KIND_BITS) - 1)
+    frame_id = word >> (_KIND_BITS + _CHECK_BITS)
+    if check != (frame_id + kind) % (1 << _CHECK_BITS) or kind > 2:
+        return None
+    return frame_id, kind
+
+
+def _draw_face(im, lms, skin):
+    hull = cv2.convexHull(lms.astype(numpy.int32))
+    cv2.fillConvexPoly(im, hull, color=skin)
+    dark = tuple(int(c * 0.4) for c in skin)
+    thickness = max(1, im.shape[1] // 400)
+    for start, end, closed in ((17, 22, False), (22, 27, False),
+                               (27, 36, False), (36, 42, True),
+                               (42, 48, True), (48, 60, True),
+                               (60, 68, True)):
+        cv2.polylines(im, [lms[start:end].astype(numpy.int32)], closed, dark,
+                      thickness)
+
+
+def _face_landmarks(rng, width, height, offset=0.):
+    template = _template()
+    scale = 0.18 * min(width, height) * rng.uniform(0.95, 1.05)
+    theta = math.radians(rng.uniform(-5, 5))
+    R = numpy.array([[math.cos(theta), -math.sin(theta)],
+                     [math.sin(theta), math.cos(theta)]])
+    centre = numpy.array([width * (0.5 + offset + rng.uniform(-0.03, 0.03)),
+                          height * (0.5 + rng.uniform(-0.03, 0.03))])
+    return template.dot(R.T) * scale + centre
+
+
+def make_sequence(out_dir, num_frames, width=1600, height=1200,
+                  dup_rate=0.05, no_face_rate=0.02, many_faces_rate=0.02,
+                  seed=0):
+    """
+    Write a synthetic sequence of JPEGs to `out_dir`.
+
+    A fraction of the frames are exact duplicates of the previous frame, have
+    no face, or have two faces. Returns the list of file names written, and
+    writes `truth.json` to `out_dir` mapping the number of each frame drawn
+    with exactly one face to its landmarks. Other frames, and duplicates, have
+    no entry.
+
+    """
+    rng = numpy.random.RandomState(seed)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    truth = {}
+    names = []
+    ys, xs = numpy.mgrid[0:height, 0:width]
+    for frame_id in range(num_frames):
+        fname = os.path.join(out_dir, "{:06d}.jpg".format(frame_id))
+        if names and rng.uniform() < dup_rate:
+            shutil.copyfile(names[-1], fname)
+            names.append(fname)
+            continue
+
+        # Background is a gradient whose brightness varies between frames.
+        base = rng.uniform(60, 160)
+        im = numpy.empty((height, width, 3), dtype=numpy.uint8)
+        for c in range(3):
+            im[:, :, c] = numpy.clip(base + 40. * xs / width
+                                          - 30. * ys / height
+                                          + rng.uniform(-20, 20), 0, 255)
+        skin = tuple(int(c) for c in rng.uniform([90, 120, 160],
+                                                 [130, 160, 220]))
+
+        r = rng.uniform()
+        if r < no_face_rate:
+            kind = NO_FACES
+        elif r < no_face_rate + many_faces_rate:
+            kind = TOO_MANY_FACES
+            _draw_face(im, _face_landmarks(rng, width, height, -0.25), skin)
+            _draw_face(im, _face_landmarks(rng, width, height, 0.25), skin)
+        else:
+            kind = FACE
+            lms = _face_landmarks(rng, width, height)
+            _draw_face(im, lms, skin)
+            truth[frame_id] = numpy.round(lms).astype(int).tolist()
+
+        _draw_marker(im, frame_id, kind)
+        cv2.imwrite(fname, im)
+        names.append(fname)
+
+    with open(os.path.join(out_dir, 'truth.json'), 'w') as f:
+        json.dump({str(k): v for k, v in truth.items()}, f)
+
+    return names
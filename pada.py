@@ -28,15 +28,31 @@ import os
 import sys
 
 import pada.align
+import pada.cache
+import pada.decode
 import pada.framedrop
+import pada.framestore
 import pada.landmarks
 import pada.logging
+import pada.preview
+import pada.render
+import pada.serve
+import pada.timing
 
 
 APP_NAME = "pada"
 APP_AUTHOR = "matthewearl"
 CONFIG_FILE_NAME = "pada.conf"
 
+# Config file sections read by each command, in addition to `global`.
+CONFIG_SECTIONS = {
+    'reference': ('align',),
+    'merge': ('align',),
+    'export': ('align',),
+    'serve': ('align', 'serve'),
+    'render': ('align', 'framedrop', 'render'),
+}
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -55,6 +71,30 @@ def parse_args():
     parser.add_argument('--filtered-files',
                         help='File to write filtered files to',
                         type=unicode)
+    parser.add_argument('--detect-scale',
+                        help='Scale factor to apply to images before face '
+                             'detection',
+                        type=float)
+    parser.add_argument('--track',
+                        help='Search for faces near the previous face first',
+                        action='store_true', default=None)
+    parser.add_argument('--profile',
+                        help='Print time spent in each stage, and write a '
+                             'JSON trace to this file',
+                        type=unicode)
+    parser.add_argument('--preview',
+                        help='Align and drop frames using small proxy images',
+                        action='store_true', default=None)
+    parser.add_argument('--replay',
+                        help='Align and drop frames at full resolution, '
+                             'reusing the decisions of the last preview',
+                        action='store_true', default=None)
+    parser.add_argument('--preview-scale',
+                        help='Factor to shrink proxy images by (2, 4 or 8)',
+                        type=int)
+    parser.add_argument('--landmark-cache',
+                        help='File to cache detected landmarks in',
+                        type=unicode)
 
     subparsers = parser.add_subparsers(help='Sub-command help')
 
@@ -69,8 +109,80 @@ def parse_args():
                               help='Input files glob', type=unicode)
     align_parser.add_argument('--img-thresh',
                               help='Max duplicate frame delta', type=float)
+    align_parser.add_argument('--dedup-mode',
+                              help='Duplicate detection method',
+                              choices=('l2', 'hash'))
+    align_parser.add_argument('--hash-thresh',
+                              help='Max differing bits between duplicate '
+                                   'image hashes',
+                              type=int)
+    align_parser.add_argument('--jobs',
+                              help='Number of worker processes', type=int)
+    align_parser.add_argument('--decode-threads',
+                              help='Number of threads reading images ahead',
+                              type=int)
+    align_parser.add_argument('--write-threads',
+                              help='Number of threads writing aligned images',
+                              type=int)
+    align_parser.add_argument('--reference',
+                              help='Face to align images to',
+                              choices=('first', 'mean'))
+    align_parser.add_argument('--out-width',
+                              help='Width of aligned images', type=int)
+    align_parser.add_argument('--out-height',
+                              help='Height of aligned images', type=int)
+    align_parser.add_argument('--crop',
+                              help='Crop aligned images to this many times '
+                                   'the size of the face',
+                              type=float)
+    align_parser.add_argument('--shard',
+                              help='Only align shard I of N (0 <= I < N), '
+                                   'given as I/N',
+                              type=unicode)
+    align_parser.add_argument('--reference-file',
+                              help='Reference face written by the reference '
+                                   'command',
+                              type=unicode)
+    align_parser.add_argument('--incremental',
+                              help='Only process images added since the last '
+                                   'run',
+                              action='store_true', default=None)
+    align_parser.add_argument('--frame-store',
+                              help='Write aligned images to a frame store '
+                                   'with this compression',
+                              choices=pada.framestore.COMPRESSIONS)
     align_parser.set_defaults(cmd='align')
 
+    reference_parser = subparsers.add_parser(
+                                  'reference',
+                                  help='Find the reference face for sharded '
+                                       'alignment')
+    reference_parser.add_argument('--input-glob',
+                                  help='Input files glob', type=unicode)
+    reference_parser.add_argument('--reference-file',
+                                  help='File to write the reference face to',
+                                  type=unicode)
+    reference_parser.set_defaults(cmd='reference')
+
+    merge_parser = subparsers.add_parser(
+                                  'merge',
+                                  help='Merge shards written by align --shard')
+    merge_parser.set_defaults(cmd='merge')
+
+    serve_parser = subparsers.add_parser(
+                                  'serve',
+                                  help='Keep aligning images as they are '
+                                       'added')
+    serve_parser.add_argument('--input-glob',
+                              help='Input files glob', type=unicode)
+    serve_parser.add_argument('--poll-interval',
+                              help='Seconds between checks for new images',
+                              type=float)
+    serve_parser.add_argument('--socket',
+                              help='Unix socket to accept requests on',
+                              type=unicode)
+    serve_parser.set_defaults(cmd='serve')
+
     framedrop_parser = subparsers.add_parser(
                                        'framedrop',
                                        help='Drop frames from a set of images')
@@ -78,10 +190,65 @@ def parse_args():
                               help='Amount to erode face mask by', type=int)
     framedrop_parser.add_argument(
                             '--frame-skip',
-                            help='Ratio of input frames to output frames',
+                            help='Ratio of input frames to output frames, or '
+                                 'a comma separated list of ratios to '
+                                 'compare',
+                            type=unicode)
+    framedrop_parser.add_argument(
+                            '--mode',
+                            help='Frame selection mode',
+                            choices=('layer', 'window'))
+    framedrop_parser.add_argument(
+                            '--skip-min',
+                            help='Minimum step between frames in window mode',
                             type=int)
+    framedrop_parser.add_argument(
+                            '--skip-max',
+                            help='Maximum step between frames in window mode',
+                            type=int)
+    framedrop_parser.add_argument(
+                            '--feature-store',
+                            help='File to cache masked frame pixels in',
+                            type=unicode)
+    framedrop_parser.add_argument(
+                            '--approx-dim',
+                            help='Compare frames using projections to this '
+                                 'many dimensions',
+                            type=int)
+    framedrop_parser.add_argument(
+                            '--approx-check',
+                            help='Compare the approximate result with the '
+                                 'exact one',
+                            action='store_true', default=None)
     framedrop_parser.set_defaults(cmd='framedrop')
 
+    export_parser = subparsers.add_parser(
+                               'export',
+                               help='Write frames in a frame store to files')
+    export_parser.add_argument('--all',
+                               help='Export every frame, rather than only '
+                                    'the filtered frames',
+                               action='store_true', default=None)
+    export_parser.set_defaults(cmd='export')
+
+    render_parser = subparsers.add_parser(
+                                    'render',
+                                    help='Align, drop frames, and encode a '
+                                         'video without intermediate files')
+    render_parser.add_argument('--input-glob',
+                               help='Input files glob', type=unicode)
+    render_parser.add_argument('--frame-skip',
+                               help='Ratio of input frames to output frames',
+                               type=int)
+    render_parser.add_argument('--output',
+                               help='Video file to write', type=unicode)
+    render_parser.add_argument('--fps',
+                               help='Output frame rate', type=float)
+    render_parser.add_argument('--encoder',
+                               help='Video encoder to use',
+                               choices=('ffmpeg', 'opencv'))
+    render_parser.set_defaults(cmd='render')
+
     return parser.parse_args()
 
 
@@ -125,8 +292,10 @@ if __name__ == "__main__":
                 d = json.load(f)
                 if 'global' in d:
                     cfg.update(d['global'])
-                if cli_args.cmd in d:
-                    cfg.update(d[cli_args.cmd])
+                for section in CONFIG_SECTIONS.get(cli_args.cmd,
+                                                   (cli_args.cmd,)):
+                    if section in d:
+                        cfg.update(d[section])
         except IOError:
             logging.warn("Could not open config file %s", config_path)
         else:
@@ -136,27 +305,221 @@ if __name__ == "__main__":
     cfg.update((k, v) for k, v in cli_args.__dict__.items() if v is not None)
     logging.debug("Config is %r", cfg)
 
-    # Execute the command by deferring to the appopriate module.
+    if cfg.get('profile'):
+        pada.timing.profiler.enabled = True
+
+    # Execute the command by deferring to the appopriate module. The landmark
+    # finder only loads the predictor if it is used.
     landmark_finder = pada.landmarks.LandmarkFinder(
-                                     os.path.expanduser(cfg['predictor_path']))
-    if cli_args.cmd == "align":
-        pada.align.align_images(
-            input_files=sorted(glob.glob(cfg['input_glob'])),
+                                     os.path.expanduser(cfg['predictor_path']),
+                                     detect_scale=cfg.get('detect_scale', 1.0),
+                                     track=cfg.get('track', False),
+                                     track_padding=cfg.get('track_padding',
+                                                           0.5))
+    # Resolution at which to decode images in each stage which supports
+    # reduced decodes.
+    reduced_decode = cfg.get('reduced_decode', {})
+    for stage in reduced_decode:
+        if stage not in pada.decode.STAGES:
+            raise Exception("Unknown reduced_decode stage {}".format(stage))
+
+    preview = cfg.get('preview', False)
+    replay = cfg.get('replay', False)
+    preview_path = cfg.get('preview_path', 'preview')
+    preview_scale = cfg.get('preview_scale', 4)
+    if preview and replay:
+        raise Exception("--preview and --replay cannot be used together")
+    if (preview or replay) and cli_args.cmd not in ("align", "framedrop"):
+        raise Exception("--preview and --replay are only supported by align "
+                        "and framedrop")
+
+    landmark_cache = None
+    if cfg.get('landmark_cache'):
+        landmark_cache = pada.cache.LandmarkCache(
+            os.path.expanduser(cfg['landmark_cache']),
+            finder_settings=landmark_finder.get_settings(),
+            hash_contents=cfg.get('landmark_cache_hash', False))
+    if cli_args.cmd in ("align", "serve"):
+        shard = None
+        if cfg.get('shard') and cli_args.cmd == "align":
+            shard = tuple(int(x) for x in cfg['shard'].split('/'))
+        align_kwargs = dict(
             out_path=cfg['aligned_path'],
             out_extension=cfg['aligned_extension'],
             landmark_finder=landmark_finder,
-            img_thresh=cfg['img_thresh'])
+            img_thresh=cfg['img_thresh'],
+            jobs=cfg.get('jobs', 1),
+            cache=landmark_cache,
+            incremental=cfg.get('incremental', False),
+            dedup_mode=cfg.get('dedup_mode', 'l2'),
+            hash_thresh=cfg.get('hash_thresh', 4),
+            decode_threads=cfg.get('decode_threads', 1),
+            write_threads=cfg.get('write_threads', 1),
+            queue_depth=cfg.get('queue_depth', 4),
+            reference=cfg.get('reference', 'first'),
+            out_width=cfg.get('out_width'),
+            out_height=cfg.get('out_height'),
+            crop=cfg.get('crop'),
+            dedup_reduce=reduced_decode.get('dedup', 1),
+            shard=shard,
+            reference_file=cfg.get('reference_file'),
+            frame_store=cfg.get('frame_store'))
+
+    if cli_args.cmd == "align":
+        input_files = sorted(glob.glob(cfg['input_glob']))
+        if preview:
+            pada.preview.align_preview(
+                input_files=input_files,
+                preview_path=preview_path,
+                scale=preview_scale,
+                threads=cfg.get('decode_threads', 1),
+                **align_kwargs)
+        elif replay:
+            pada.preview.replay_align(
+                input_files=input_files,
+                preview_path=preview_path,
+                **align_kwargs)
+        else:
+            pada.align.align_images(input_files=input_files, **align_kwargs)
+    elif cli_args.cmd == "serve":
+        pada.serve.serve(
+            input_glob=cfg['input_glob'],
+            poll_interval=cfg.get('poll_interval', 2.0),
+            socket_path=cfg.get('socket'),
+            **align_kwargs)
+    elif cli_args.cmd == "reference":
+        pada.align.write_reference(
+            fname=cfg['reference_file'],
+            input_files=sorted(glob.glob(cfg['input_glob'])),
+            landmark_finder=landmark_finder,
+            cache=landmark_cache,
+            hash_images=(cfg.get('dedup_mode', 'l2') == 'hash'))
+    elif cli_args.cmd == "merge":
+        pada.align.merge_shards(cfg['aligned_path'],
+                                landmark_finder=landmark_finder,
+                                cache=landmark_cache)
     elif cli_args.cmd == "framedrop":
-        input_files_glob = os.path.join(
-                                       cfg['aligned_path'],
-                                       '*.{}'.format(cfg['aligned_extension']))
-        filtered_files = pada.framedrop.filter_files(
-            input_files=sorted(glob.glob(input_files_glob)),
+        framedrop_settings = {
+            'aligned_path': cfg['aligned_path'],
+            'filtered_files': cfg['filtered_files'],
+            'feature_store': cfg.get('feature_store'),
+            'erode_amount': cfg['erode_amount'],
+        }
+        if preview or replay:
+            preview_framedrop = pada.preview.preview_settings(
+                                     preview_path, preview_scale,
+                                     filtered_files=cfg['filtered_files'],
+                                     feature_store=cfg.get('feature_store'),
+                                     erode_amount=cfg['erode_amount'])
+        if preview:
+            framedrop_settings = preview_framedrop
+        frame_store = None
+        if pada.framestore.is_frame_store(framedrop_settings['aligned_path']):
+            frame_store = pada.framestore.FrameStore(
+                                         framedrop_settings['aligned_path'])
+            input_files = frame_store.names
+        else:
+            # Aligned images are numbered, which excludes the face mask.
+            input_files = sorted(glob.glob(os.path.join(
+                                  framedrop_settings['aligned_path'],
+                                  '[0-9]*.{}'.format(
+                                                 cfg['aligned_extension']))))
+        filtered_fname = framedrop_settings['filtered_files']
+        # `frame_skip` may be a number, a list, or a comma separated string.
+        frame_skips = cfg['frame_skip']
+        if isinstance(frame_skips, basestring):
+            frame_skips = [int(k) for k in frame_skips.split(',')]
+        elif not isinstance(frame_skips, list):
+            frame_skips = [frame_skips]
+        framedrop_kwargs = dict(
+            input_files=input_files,
+            erode_amount=framedrop_settings['erode_amount'],
+            landmark_finder=landmark_finder,
+            cache=landmark_cache,
+            feature_store=framedrop_settings['feature_store'],
+            mode=cfg.get('mode', 'layer'),
+            skip_min=cfg.get('skip_min'),
+            skip_max=cfg.get('skip_max'),
+            decode_reduce=reduced_decode.get('framedrop', 1),
+            approx_dim=cfg.get('approx_dim'),
+            face_mask=pada.align.read_face_mask(
+                                         framedrop_settings['aligned_path']),
+            frame_store=frame_store)
+
+        if replay:
+            filtered = [(filtered_fname, pada.preview.replay_filtered(
+                             preview_path=preview_path,
+                             filtered_files=preview_framedrop[
+                                                         'filtered_files'],
+                             out_path=cfg['aligned_path'],
+                             out_extension=cfg['aligned_extension']))]
+        elif len(frame_skips) == 1:
+            filtered = [(filtered_fname, pada.framedrop.filter_files(
+                             frame_skip=frame_skips[0],
+                             approx_check=cfg.get('approx_check', False),
+                             **framedrop_kwargs))]
+        else:
+            # Write a file list for each setting, named after the setting,
+            # and a summary of the results.
+            results = pada.framedrop.sweep_files(frame_skips=frame_skips,
+                                                 **framedrop_kwargs)
+            num_frames = len(framedrop_kwargs['input_files'])
+            base, ext = os.path.splitext(filtered_fname)
+            filtered = []
+            summary = ["frame_skip   kept  kept %   path cost"]
+            for frame_skip, (files, cost) in zip(frame_skips, results):
+                filtered.append(("{}-{}{}".format(base, frame_skip, ext),
+                                 files))
+                summary.append("{:10} {:6} {:7.1f} {:11.1f}".format(
+                                       frame_skip, len(files),
+                                       100. * len(files) / num_frames, cost))
+            summary = "\n".join(summary)
+            print summary
+            with open("{}-summary{}".format(base, ext), 'w') as f:
+                f.write(summary + "\n")
+
+        for fname, filtered_files in filtered:
+            with open(fname, 'w') as f:
+                for n in filtered_files:
+                    f.write("{}\n".format(n))
+    elif cli_args.cmd == "export":
+        store = pada.framestore.FrameStore(cfg['aligned_path'])
+        if cfg.get('all'):
+            names = store.names
+        else:
+            with open(cfg['filtered_files']) as f:
+                names = [l.strip() for l in f if l.strip()]
+        pada.framestore.export_frames(
+            store, names,
+            threads=cfg.get('write_threads', 1),
+            queue_depth=cfg.get('queue_depth', 4))
+    elif cli_args.cmd == "render":
+        # `framedrop` accepts several `frame_skip` values to compare, but a
+        # video can only be rendered with one.
+        if not isinstance(cfg['frame_skip'], (int, long)):
+            raise Exception("render needs a single frame_skip value, not "
+                            "{!r}".format(cfg['frame_skip']))
+        pada.render.render_video(
+            input_files=sorted(glob.glob(cfg['input_glob'])),
+            out_fname=cfg['output'],
+            landmark_finder=landmark_finder,
             frame_skip=cfg['frame_skip'],
             erode_amount=cfg['erode_amount'],
-            landmark_finder=landmark_finder)
-
-        with open(cfg['filtered_files'], 'w') as f:
-            for fname in filtered_files:
-                f.write("{}\n".format(fname))
+            img_thresh=cfg['img_thresh'],
+            cache=landmark_cache,
+            dedup_mode=cfg.get('dedup_mode', 'l2'),
+            hash_thresh=cfg.get('hash_thresh', 4),
+            mode=cfg.get('mode', 'layer'),
+            skip_min=cfg.get('skip_min'),
+            skip_max=cfg.get('skip_max'),
+            fps=cfg.get('fps', 30),
+            encoder=cfg.get('encoder', 'ffmpeg'),
+            out_width=cfg.get('out_width'),
+            out_height=cfg.get('out_height'),
+            crop=cfg.get('crop'),
+            dedup_reduce=reduced_decode.get('dedup', 1))
 
+    if pada.timing.profiler.enabled:
+        print pada.timing.profiler.summary()
+        pada.timing.profiler.write_trace(cfg['profile'])
+        logging.info("Wrote profile trace to %s", cfg['profile'])
@@ -23,29 +23,82 @@
 
 __all__ = (
     'align_images',
+    'merge_shards',
+    'read_face_mask',
+    'read_metadata',
+    'write_reference',
 )
 
 
+import collections
 import glob
+import json
+import multiprocessing
 import os
+import resource
+import sys
+import time
 
 import cv2
-import dlib
 import numpy
 import scipy
 
+from . import decode
+from . import dedup
+from . import framestore
 from . import landmarks
+from . import pipeline
+from . import procrustes
 from .logging import logger
+from .timing import profiler
 
 
-def read_ims(names, img_thresh):
+MANIFEST_NAME = "manifest.json"
+MASK_NAME = "mask.png"
+METADATA_NAME = "metadata.json"
+_SHARD_GLOB = "shard-*-of-*"
+_MANIFEST_VERSION = 2
+_METADATA_VERSION = 1
+
+
+@profiler.timed('dedup')
+def image_distance(im1, im2):
+    """
+    Return the L2 distance between two images of the same shape.
+
+    """
+    return cv2.norm(im1, im2, cv2.NORM_L2)
+
+
+def _read_im(n):
+    logger.debug("Reading image %s", n)
+    with profiler.stage('decode'):
+        return n, decode.imread(n)
+
+
+def _read_dedup_im(n, reduce):
+    if reduce == 1:
+        return _read_im(n)
+    logger.debug("Reading reduced image %s", n)
+    with profiler.stage('decode.reduced'):
+        return n, decode.imread(n, reduce)
+
+
+def dedup_distance(prev_im, im, reduce):
+    """
+    Return the distance between two images decoded at 1/`reduce` resolution,
+    scaled to approximate the distance between the full resolution images.
+
+    """
+    return image_distance(prev_im, im) * reduce
+
+
+def _drop_duplicates(ims, img_thresh, prev_im, reduce):
     count = 0
     total = 0
-    prev_im = None
-    for n in names:
-        logger.debug("Reading image %s", n)
-        im = cv2.imread(n)
-        if prev_im is None or numpy.linalg.norm(prev_im - im) > img_thresh:
+    for n, im in ims:
+        if (prev_im is None or img_thresh is None or
+                dedup_distance(prev_im, im, reduce) > img_thresh):
             yield (n, im)
             count += 1
             prev_im = im
@@ -55,48 +108,110 @@ def read_ims(names, img_thresh):
     logger.info("Read %s / %s images", count, total)
 
 
-def orthogonal_procrustes(points1, points2):
+class _DuplicateCheck(object):
     """
-    Return an affine transformation [s * R | T] such that:
+    Check whether an image whose hash matches that of an earlier image is a
+    duplicate of it, for :func:`.dedup.find_duplicates`.
 
-        sum ||s*R*p1,i + T - p2,i||^2
+    As in `'l2'` dedup mode, images are duplicates if their distance is at most
+    `img_thresh`. It is measured on 1/:data:`.dedup.HASH_REDUCE` resolution
+    decodes, the last few of which are kept.
+
+    """
+    def __init__(self, img_thresh, cache_size=16):
+        self.img_thresh = img_thresh
+        self.cache_size = cache_size
+        self._ims = collections.OrderedDict()
+
+    def _read(self, n):
+        im = self._ims.pop(n, None)
+        if im is None:
+            im = _read_dedup_im(n, dedup.HASH_REDUCE)[1]
+            if len(self._ims) >= self.cache_size:
+                self._ims.popitem(last=False)
+        self._ims[n] = im
+        return im
+
+    def __call__(self, n, orig):
+        orig_im = self._read(orig)
+        im = self._read(n)
+        return (im.shape == orig_im.shape and
+                dedup_distance(orig_im, im, dedup.HASH_REDUCE) <=
+                                                              self.img_thresh)
 
-    is minimized.
 
+def hash_duplicate_check(img_thresh):
     """
-    # Solve the procrustes problem by subtracting centroids, scaling by the
-    # standard deviation, and then using the SVD to calculate the rotation. See
-    # the following for more details:
-    #   https://en.wikipedia.org/wiki/Orthogonal_Procrustes_problem
+    Return the `is_duplicate` argument to pass to
+    :func:`.dedup.find_duplicates`, so that hash matches are only duplicates
+    if they are within `img_thresh` of each other. If `img_thresh` is `None`
+    every hash match is a duplicate.
 
-    points1 = points1.astype(numpy.float64)
-    points2 = points2.astype(numpy.float64)
+    """
+    if img_thresh is None:
+        return None
+    return _DuplicateCheck(img_thresh)
 
-    c1 = numpy.mean(points1, axis=0)
-    c2 = numpy.mean(points2, axis=0)
-    points1 -= c1
-    points2 -= c2
 
-    s1 = numpy.std(points1)
-    s2 = numpy.std(points2)
-    points1 /= s1
-    points2 /= s2
+def read_ims(names, img_thresh, prev_name=None, decode_threads=0,
+             queue_depth=4, dedup_reduce=1):
+    """
+    Yield `(n, im)` for each image in `names` whose distance from the previous
+    image kept (initially `prev_name`, if given) is more than `img_thresh`.
 
-    U, S, Vt = numpy.linalg.svd(points1.T * points2)
+    If `dedup_reduce` is more than 1 the distances are measured on reduced
+    resolution decodes (see :func:`.dedup_distance`), and only the images
+    which are kept are decoded at full resolution.
 
-    # The R we seek is in fact the transpose of the one given by U * Vt. This
-    # is because the above formulation assumes the matrix goes on the right
-    # (with row vectors) where as our solution requires the matrix to be on the
-    # left (with column vectors).
-    R = (U * Vt).T
+    """
+    if img_thresh is None or dedup_reduce == 1:
+        dedup_reduce = 1
+    prev_im = None
+    if prev_name is not None and img_thresh is not None:
+        prev_im = _read_dedup_im(prev_name, dedup_reduce)[1]
 
-    return numpy.vstack([numpy.hstack(((s2 / s1) * R,
-                                       c2.T - (s2 / s1) * R * c1.T)),
-                         numpy.matrix([0., 0., 1.])])
+    ims = _drop_duplicates(
+                  pipeline.prefetch(lambda n: _read_dedup_im(n, dedup_reduce),
+                                    names, decode_threads, queue_depth),
+                  img_thresh, prev_im, dedup_reduce)
+    if dedup_reduce != 1:
+        ims = pipeline.prefetch(_read_im, (n for n, im in ims),
+                                decode_threads, queue_depth)
+    for n, im in ims:
+        yield n, im
 
 
-def warp_im(im, M, dshape):
-    output_im = numpy.zeros(dshape, dtype=im.dtype)
+@profiler.timed('procrustes')
+def orthogonal_procrustes(points1, points2):
+    """
+    Return an affine transformation [s * R | T] such that:
+
+        sum ||s*R*p1,i + T - p2,i||^2
+
+    is minimized.
+
+    This is :func:`.procrustes.batch_procrustes` for a single pair of point
+    sets, so that frames aligned one at a time match frames aligned in a
+    batch.
+
+    """
+    return numpy.matrix(procrustes.batch_procrustes(points1, points2)[0])
+
+
+@profiler.timed('warp')
+def warp_im(im, M, dshape, out=None):
+    """
+    Warp `im` with the inverse of the affine transform `M`.
+
+    If `out` is given, and has shape `dshape`, the result is written into it
+    rather than into a newly allocated image.
+
+    """
+    if out is not None and out.shape == tuple(dshape):
+        output_im = out
+        output_im.fill(0)
+    else:
+        output_im = numpy.zeros(dshape, dtype=im.dtype)
     cv2.warpAffine(im,
                    M[:2],
                    (dshape[1], dshape[0]),
@@ -106,11 +221,87 @@ def warp_im(im, M, dshape):
     return output_im
 
 
-def get_ims_and_landmarks(images, landmark_finder):
+def output_transform(ref_landmarks, ref_shape, width=None, height=None,
+                     crop=None):
+    """
+    Return the geometry of aligned images.
+
+    By default aligned images are the same size as the reference image. If
+    `crop` is given the output is instead a box centred on the reference face,
+    `crop` times the size of the face. If `width` and/or `height` are given the
+    box is scaled to fit, and grown along one axis to match the aspect ratio
+    if both are given.
+
+    Returns `(A, shape)` where `A` is a 3x3 affine transformation from output
+    pixel coordinates to reference coordinates, and `shape` is the output image
+    shape. Composing `A` with a transformation found by
+    :func:`.orthogonal_procrustes` makes :func:`.warp_im` produce the output
+    image directly. If none of the options are given `(None, None)` is
+    returned, and each image is warped at its own size.
+
+    """
+    if width is None and height is None and crop is None:
+        return None, None
+
+    if crop is None:
+        box_w, box_h = float(ref_shape[1]), float(ref_shape[0])
+        cx, cy = box_w / 2., box_h / 2.
+    else:
+        points = numpy.asarray(ref_landmarks, dtype=numpy.float64)
+        lo, hi = points.min(axis=0), points.max(axis=0)
+        cx, cy = (lo + hi) / 2.
+        box_w = box_h = crop * numpy.max(hi - lo)
+
+    if width is None and height is None:
+        scale = 1.
+    elif height is None:
+        scale = float(width) / box_w
+    elif width is None:
+        scale = float(height) / box_h
+    else:
+        scale = min(float(width) / box_w, float(height) / box_h)
+    out_w = width if width is not None else int(round(box_w * scale))
+    out_h = height if height is not None else int(round(box_h * scale))
+
+    # Map the centre of each output pixel to the corresponding point in the
+    # box, which is centred on (cx, cy).
+    x0 = cx - out_w / (2. * scale) + 0.5 / scale - 0.5
+    y0 = cy - out_h / (2. * scale) + 0.5 / scale - 0.5
+    A = numpy.array([[1. / scale, 0., x0],
+                     [0., 1. / scale, y0],
+                     [0., 0., 1.]])
+    return A, (out_h, out_w) + tuple(ref_shape[2:])
+
+
+def output_landmarks(lms, A):
+    """
+    Map landmarks `lms` in reference coordinates to output pixel coordinates,
+    where `A` is as returned by :func:`.output_transform`.
+
+    """
+    points = numpy.vstack([numpy.asarray(lms, dtype=numpy.float64).T,
+                           numpy.ones(len(lms))])
+    return numpy.dot(numpy.linalg.inv(A), points)[:2].T
+
+
+def find_landmarks(n, im, landmark_finder, cache=None):
+    """
+    Find landmarks in image `im`, which was read from the file `n`.
+
+    If a :class:`.LandmarkCache` is given it is consulted before running the
+    landmark finder.
+
+    """
+    if cache is not None:
+        return cache.get(n, im, landmark_finder)
+    return landmark_finder.get(im)
+
+
+def get_ims_and_landmarks(images, landmark_finder, cache=None):
     count = 0
     for n, im in images:
         try:
-            l = landmark_finder.get(im)
+            l = find_landmarks(n, im, landmark_finder, cache)
         except landmarks.NoFaces:
             logger.warn("No faces in image %s", n)
         except landmarks.TooManyFaces:
@@ -121,8 +312,712 @@ def get_ims_and_landmarks(images, landmark_finder):
     logger.info("Read %s images with landmarks", count)
 
 
+@profiler.timed('color.mean')
+def face_color(im, lms):
+    """
+    Return the mean BGR colour of the face described by `lms` in `im`.
+
+    Only the bounding box of the face is masked, so no full size temporaries
+    are allocated. If the face covers no pixels of `im` the colour is NaN.
+
+    """
+    points = numpy.asarray(lms, dtype=numpy.int32)
+    x, y, w, h = cv2.boundingRect(points)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, im.shape[1]), min(y + h, im.shape[0])
+    no_color = numpy.full(im.shape[2], numpy.nan)
+    if x1 <= x0 or y1 <= y0:
+        return no_color
+
+    mask = numpy.zeros((y1 - y0, x1 - x0), dtype=numpy.uint8)
+    landmarks.draw_convex_hull(mask, points - numpy.int32([x0, y0]), color=1)
+    if not mask.any():
+        return no_color
+    return numpy.array(cv2.mean(im[y0:y1, x0:x1], mask=mask)[:im.shape[2]])
+
+
+def color_scale(ref_color, color):
+    """
+    Return the factor to scale each channel of an image of colour `color` by
+    to correct it to `ref_color`.
+
+    If either colour is NaN (see :func:`.face_color`) the image is left as it
+    is.
+
+    """
+    scale = numpy.asarray(ref_color, dtype=numpy.float64) / color
+    if not numpy.all(numpy.isfinite(scale)):
+        return numpy.ones_like(scale)
+    return scale
+
+
+def color_lut(ref_color, color):
+    """
+    Return a lookup table for :func:`cv2.LUT` which scales each channel by
+    :func:`.color_scale`.
+
+    Values are rounded and saturated in the same way as converting the
+    floating point product to uint8 with :func:`cv2.imwrite`.
+
+    """
+    lut = numpy.arange(256)[:, numpy.newaxis] * color_scale(ref_color, color)
+    return numpy.clip(numpy.rint(lut), 0, 255).astype(numpy.uint8).reshape(
+                                                                 (256, 1, -1))
+
+
+@profiler.timed('color.correct')
+def correct_color(im, ref_color, color):
+    """
+    Scale the colour of uint8 image `im` by `ref_color / color`, in place.
+
+    """
+    cv2.LUT(im, color_lut(ref_color, color), dst=im)
+    return im
+
+
+def align_im(im, M, color, ref_color, buf=None, dshape=None):
+    """
+    Warp `im` onto the reference landmarks and colour correct it.
+
+    `M` is the transformation from the reference landmarks to the image's
+    landmarks, as returned by :func:`.orthogonal_procrustes`, optionally
+    composed with the `A` returned by :func:`.output_transform`. `dshape` is
+    the shape of the result, which defaults to the shape of `im`.
+
+    `buf` is an optional image to warp into, which is reused if it has the
+    right shape. The image actually used is returned.
+
+    """
+    if dshape is None:
+        dshape = im.shape
+    warped = warp_im(im, M, dshape, out=buf)
+    return correct_color(warped, ref_color, color)
+
+
+def write_aligned(im, M, color, ref_color, out_fname, buf=None, dshape=None):
+    """
+    Align `im` with :func:`.align_im` and write the result to `out_fname`.
+
+    The image written is returned, so that it can be passed in as `buf` for
+    the next frame.
+
+    """
+    warped = align_im(im, M, color, ref_color, buf, dshape)
+    with profiler.stage('encode'):
+        cv2.imwrite(out_fname, warped)
+    logger.debug("Wrote file %s", out_fname)
+    return warped
+
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on OS X, and kilobytes elsewhere.
+    if sys.platform == 'darwin':
+        rss /= 1024.
+    return rss / 1024.
+
+
+def _chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+# Landmark finder used by pool workers. Set once per process by
+# `_init_worker`, so that the predictor is only loaded once per worker.
+_worker_landmark_finder = None
+
+
+def _init_worker(landmark_finder, profile):
+    global _worker_landmark_finder
+    _worker_landmark_finder = landmark_finder
+    profiler.enabled = profile
+    profiler.drain()
+
+
+def _landmarks_and_color(landmark_finder, im, cached=None):
+    """
+    Return `(lms, color)` for the image, or `(exc_type, None)` if the image
+    does not have exactly one face.
+
+    `cached` is a result previously returned by :meth:`.LandmarkCache.lookup`,
+    in which case the landmark finder is not run, and its tracking is reset.
+
+    """
+    if cached is None:
+        try:
+            lms = landmark_finder.get(im)
+        except (landmarks.NoFaces, landmarks.TooManyFaces) as e:
+            return type(e), None
+    else:
+        landmark_finder.reset_tracking()
+        if isinstance(cached, type):
+            return cached, None
+        lms = cached
+    return lms, face_color(im, lms)
+
+
+def _scan_chunk(args):
+    """
+    Pool task: Read a contiguous run of images, and find landmarks in each.
+
+    Returns a list of `(n, dist, lms, color)` tuples, along with the landmark
+    finder's stats and the profiler events for the chunk. In each tuple `dist`
+    is the distance to the preceding input image (`None` for the very first
+    image), as returned by :func:`.dedup_distance`. Landmarks are not computed
+    for images that will probably be dropped as duplicates, in which case
+    `lms` is `None`. Landmarks which were found in the landmark cache by the
+    parent are passed in `cached`.
+
+    Face tracking starts afresh in each chunk, since a worker's previous chunk
+    is generally not the one before this chunk.
+
+    """
+    prev_name, names, cached, img_thresh, dedup_reduce = args
+    _worker_landmark_finder.reset_tracking()
+    if img_thresh is None:
+        dedup_reduce = 1
+    prev_im = None
+    if prev_name is not None and img_thresh is not None:
+        prev_im = _read_dedup_im(prev_name, dedup_reduce)[1]
+    out = []
+    for n, c in zip(names, cached):
+        _, dedup_im = _read_dedup_im(n, dedup_reduce)
+        dist = None
+        if prev_im is not None and img_thresh is not None:
+            dist = dedup_distance(prev_im, dedup_im, dedup_reduce)
+        if dist is not None and dist <= img_thresh:
+            lms, color = None, None
+        else:
+            im = dedup_im if dedup_reduce == 1 else _read_im(n)[1]
+            lms, color = _landmarks_and_color(_worker_landmark_finder, im, c)
+        out.append((n, dist, lms, color))
+        prev_im = dedup_im
+
+    stats = _worker_landmark_finder.stats
+    _worker_landmark_finder.stats = collections.Counter()
+    return out, stats, profiler.drain()
+
+
+def _scan_results(pool, chunks, stats):
+    """
+    Yield the results of running :func:`._scan_chunk` over `chunks` in order,
+    accumulating the workers' landmark finder stats in `stats`.
+
+    """
+    for out, chunk_stats, events in pool.imap(_scan_chunk, chunks):
+        stats.update(chunk_stats)
+        profiler.merge(events)
+        for r in out:
+            yield r
+
+
+def _write_chunk(args):
+    """
+    Pool task: Warp and write a set of images whose transformations are
+    known.
+
+    If `frame_store` is set the images are written to new frame store chunks
+    rather than to files. Returns the profiler events for the chunk, along
+    with the chunks to add to the frame store (or `None`).
+
+    """
+    items, ref_color, dshape, frame_store = args
+
+    if frame_store is None:
+        buf = None
+        for n, M, color, out_fname in items:
+            with profiler.stage('decode'):
+                im = cv2.imread(n)
+            buf = write_aligned(im, M, color, ref_color, out_fname, buf,
+                                dshape)
+        return profiler.drain(), None
+
+    def aligned_ims():
+        buf = None
+        for n, M, color, out_fname in items:
+            with profiler.stage('decode'):
+                im = cv2.imread(n)
+            buf = align_im(im, M, color, ref_color, buf, dshape)
+            yield out_fname, buf
+
+    chunks = framestore.write_chunk(os.path.dirname(items[0][3]),
+                                    aligned_ims(), frame_store)
+    return profiler.drain(), chunks
+
+
+def _open_writer(out_path, frame_store, write_threads, queue_depth):
+    """
+    Return a writer for aligned images: a :class:`.FrameStoreWriter` if
+    `frame_store` is set, or else an :class:`.AsyncWriter`.
+
+    """
+    if frame_store is not None:
+        return framestore.FrameStoreWriter(out_path, frame_store)
+    return pipeline.AsyncWriter(write_threads, queue_depth)
+
+
+class _AlignState(object):
+    """
+    State which is carried from one image to the next by
+    :func:`.align_images`, and between runs in incremental mode.
+
+    """
+    def __init__(self):
+        # Last input image which was not dropped as a duplicate, and every
+        # input image which was not, whether or not it had a face.
+        self.prev_name = None
+        self.kept = []
+        self.ref_landmarks = None
+        self.ref_color = None
+        # Shape of the image the reference landmarks were taken from.
+        self.ref_shape = None
+        self.next_idx = 0
+        # Input image that each output image was made from, along with the
+        # transformation from output to input pixel coordinates, and the
+        # factor applied to each colour channel.
+        self.outputs = []
+        self.transforms = []
+        self.color_scales = []
+
+    def add_output(self, n, M, color):
+        self.outputs.append(n)
+        self.transforms.append(numpy.asarray(M)[:2].tolist())
+        self.color_scales.append(color_scale(self.ref_color, color).tolist())
+        self.next_idx += 1
+
+
+def _state_from_dict(d):
+    state = _AlignState()
+    state.prev_name = d['prev_name']
+    state.kept = d.get('kept', [])
+    if d['ref_landmarks'] is not None:
+        state.ref_landmarks = numpy.matrix(d['ref_landmarks'])
+        state.ref_color = numpy.array(d['ref_color'])
+    if d.get('ref_shape') is not None:
+        state.ref_shape = tuple(d['ref_shape'])
+    state.next_idx = d['next_idx']
+    state.outputs = d.get('outputs', [])
+    state.transforms = d.get('transforms', [])
+    state.color_scales = d.get('color_scales', [])
+    return state
+
+
+def _file_stamp(fname):
+    st = os.stat(fname)
+    return [fname, st.st_size, st.st_mtime]
+
+
+def _read_hashes(fname):
+    """
+    Return a dict mapping file names to the image hashes stored in the JSON
+    file `fname` (a manifest or reference file), keeping only those whose
+    files are unchanged on disk. See :func:`._hash_entries`.
+
+    """
+    try:
+        with open(fname) as f:
+            entries = json.load(f).get('hashes', {})
+    except IOError:
+        return {}
+    hashes = {}
+    for n, (size, mtime, h) in entries.items():
+        try:
+            if _file_stamp(n) == [n, size, mtime]:
+                hashes[n] = h
+        except OSError:
+            pass
+    return hashes
+
+
+def _hash_entries(names, hashes):
+    """
+    Return the hashes in `hashes` of the files `names` in the form stored in
+    manifests, keyed by file name along with the size and modification time
+    of each file.
+
+    """
+    return dict((n, _file_stamp(n)[1:] + [hashes[n]])
+                    for n in names if n in hashes)
+
+
+def _read_manifest(out_path, settings, input_files):
+    """
+    Read the manifest left by a previous run in `out_path`.
+
+    Returns `(state, new_files)` if the previous run used the same settings
+    and processed a prefix of `input_files` which is unchanged on disk.
+    Otherwise `None` is returned.
+
+    """
+    try:
+        with open(os.path.join(out_path, MANIFEST_NAME)) as f:
+            d = json.load(f)
+    except IOError:
+        logger.info("No manifest in %s", out_path)
+        return None
+
+    if d.get('version') != _MANIFEST_VERSION or d['settings'] != settings:
+        logger.info("Settings have changed since the last run")
+        return None
+    inputs = d['inputs']
+    try:
+        changed = (len(inputs) > len(input_files) or
+                   any(stamp != _file_stamp(n)
+                       for stamp, n in zip(inputs, input_files)))
+    except OSError:
+        changed = True
+    if changed:
+        logger.info("Previously processed inputs have changed")
+        return None
+
+    return _state_from_dict(d), input_files[len(inputs):]
+
+
+def _write_manifest(out_path, settings, inputs, state, shard=None,
+                    hashes=None):
+    """
+    Write a manifest to `out_path`. `inputs` holds the :func:`._file_stamp` of
+    each input file, and `hashes` the image hashes found in `'hash'` dedup
+    mode, as returned by :func:`._hash_entries`.
+
+    """
+    d = {
+        'version': _MANIFEST_VERSION,
+        'settings': settings,
+        'shard': shard,
+        'inputs': inputs,
+        'prev_name': state.prev_name,
+        'kept': state.kept,
+        'ref_landmarks': None,
+        'ref_color': None,
+        'ref_shape': state.ref_shape,
+        'next_idx': state.next_idx,
+        'outputs': state.outputs,
+        'transforms': state.transforms,
+        'color_scales': state.color_scales,
+        'hashes': hashes or {},
+    }
+    if state.ref_landmarks is not None:
+        d['ref_landmarks'] = numpy.asarray(state.ref_landmarks).tolist()
+        d['ref_color'] = numpy.asarray(state.ref_color).tolist()
+
+    tmp_path = os.path.join(out_path, "{}.tmp".format(MANIFEST_NAME))
+    with open(tmp_path, 'w') as f:
+        json.dump(d, f)
+    os.rename(tmp_path, os.path.join(out_path, MANIFEST_NAME))
+
+
+def _write_metadata(out_path, settings, state):
+    """
+    Write the face mask of the reference face in output coordinates to
+    `out_path`, along with a JSON sidecar holding the output image shape, the
+    reference landmarks in output coordinates, and the transformation and
+    colour scale of each aligned image.
+
+    """
+    if state.ref_landmarks is None:
+        return
+    A, shape = output_transform(state.ref_landmarks, state.ref_shape,
+                                width=settings['out_width'],
+                                height=settings['out_height'],
+                                crop=settings['crop'])
+    if A is None:
+        A, shape = numpy.identity(3), state.ref_shape
+    lms = output_landmarks(state.ref_landmarks, A)
+
+    mask = landmarks.get_face_mask(shape, numpy.rint(lms).astype(numpy.int32))
+    cv2.imwrite(os.path.join(out_path, MASK_NAME),
+                (mask * 255).astype(numpy.uint8))
+    d = {
+        'version': _METADATA_VERSION,
+        'shape': list(shape[:2]),
+        'landmarks': lms.tolist(),
+        'mask': MASK_NAME,
+        'files': ["{:08d}.{}".format(i, settings['out_extension'])
+                      for i in range(state.next_idx)],
+        'inputs': state.outputs,
+        'transforms': state.transforms,
+        'color_scales': state.color_scales,
+    }
+    tmp_path = os.path.join(out_path, "{}.tmp".format(METADATA_NAME))
+    with open(tmp_path, 'w') as f:
+        json.dump(d, f)
+    os.rename(tmp_path, os.path.join(out_path, METADATA_NAME))
+
+
+def read_metadata(out_path):
+    """
+    Return the metadata written alongside the aligned images in `out_path` by
+    :func:`.align_images`, or `None` if there is none.
+
+    """
+    try:
+        with open(os.path.join(out_path, METADATA_NAME)) as f:
+            d = json.load(f)
+    except IOError:
+        return None
+    if d.get('version') != _METADATA_VERSION:
+        logger.warn("Ignoring metadata in %s from an older version", out_path)
+        return None
+    return d
+
+
+def read_face_mask(out_path):
+    """
+    Return the boolean face mask written alongside the aligned images in
+    `out_path`, or `None` if there is none.
+
+    The mask has the shape of the aligned images, as given by their metadata.
+
+    """
+    d = read_metadata(out_path)
+    if d is None:
+        return None
+    mask = cv2.imread(os.path.join(out_path, d['mask']), cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        return None
+    if list(mask.shape) != d['shape']:
+        raise Exception("Face mask in {} does not match the aligned image "
+                        "size {}x{}".format(out_path, d['shape'][1],
+                                            d['shape'][0]))
+    return mask > 127
+
+
+def _mean_reference(frames):
+    """
+    Return the transformation of each of `frames` (a list of
+    `(n, lms, color)` tuples) from the mean face, along with the mean face's
+    landmarks and colour. Faces with no colour are left out of the mean colour.
+
+    """
+    points = numpy.array([lms for n, lms, color in frames])
+    mean, Ms = procrustes.generalized_procrustes(points)
+    ref_color = numpy.nanmean([color for n, lms, color in frames], axis=0)
+    return Ms, numpy.matrix(mean), ref_color
+
+
+def _align_images_serial(input_files, out_path, out_extension,
+                         landmark_finder, img_thresh, cache, state,
+                         decode_threads, write_threads, queue_depth,
+                         reference, geometry, dedup_reduce, frame_store):
+    def record_prev(images):
+        for n, im in images:
+            state.prev_name = n
+            state.kept.append(n)
+            yield n, im
+
+    # Process each file in turn. Images are decoded ahead on
+    # `decode_threads` threads, and written on `write_threads` threads, with
+    # output buffers recycled once they have been written.
+    ims = read_ims(input_files, img_thresh=img_thresh,
+                   prev_name=state.prev_name, decode_threads=decode_threads,
+                   queue_depth=queue_depth, dedup_reduce=dedup_reduce)
+    ims_and_landmarks = get_ims_and_landmarks(record_prev(ims),
+                                              landmark_finder, cache)
+    if reference == 'mean':
+        _align_to_mean(ims_and_landmarks, out_path, out_extension, state,
+                       decode_threads, write_threads, queue_depth, geometry,
+                       frame_store)
+        landmark_finder.log_stats()
+        return
+
+    transform = None
+    with _open_writer(out_path, frame_store, write_threads,
+                      queue_depth) as writer:
+        for n, im, lms in ims_and_landmarks:
+            color = face_color(im, lms)
+            if state.ref_landmarks is None:
+                state.ref_landmarks = lms
+                state.ref_shape = im.shape
+            if state.ref_color is None:
+                state.ref_color = color
+            if transform is None:
+                transform = output_transform(state.ref_landmarks,
+                                             state.ref_shape, **geometry)
+            A, dshape = transform
+            out_fname = os.path.join(out_path,
+                                     "{:08d}.{}".format(state.next_idx,
+                                                        out_extension))
+            M = orthogonal_procrustes(state.ref_landmarks, lms)
+            if A is not None:
+                M = numpy.dot(M, A)
+            writer.write(out_fname,
+                         align_im(im, M, color, state.ref_color,
+                                  writer.get_buffer(), dshape))
+            state.add_output(n, M, color)
+    landmark_finder.log_stats()
+
+
+def _align_to_mean(ims_and_landmarks, out_path, out_extension, state,
+                   decode_threads, write_threads, queue_depth, geometry,
+                   frame_store):
+    """
+    Serial implementation of :func:`.align_images` with `reference='mean'`.
+
+    The landmarks and colour of every image are collected first, without
+    holding on to the images, so that the mean face can be found. The images
+    are then read again to be warped.
+
+    """
+    frames = []
+    for n, im, lms in ims_and_landmarks:
+        if state.ref_shape is None:
+            state.ref_shape = im.shape
+        frames.append((n, lms, face_color(im, lms)))
+    if not frames:
+        return
+    Ms, state.ref_landmarks, state.ref_color = _mean_reference(frames)
+    A, dshape = output_transform(state.ref_landmarks, state.ref_shape,
+                                 **geometry)
+    if A is not None:
+        Ms = numpy.matmul(Ms, A)
+
+    ims = pipeline.prefetch(_read_im, [n for n, lms, color in frames],
+                            decode_threads, queue_depth)
+    with _open_writer(out_path, frame_store, write_threads,
+                      queue_depth) as writer:
+        for i, (n, im) in enumerate(ims):
+            out_fname = os.path.join(out_path,
+                                     "{:08d}.{}".format(state.next_idx,
+                                                        out_extension))
+            color = frames[i][2]
+            writer.write(out_fname,
+                         align_im(im, Ms[i], color, state.ref_color,
+                                  writer.get_buffer(), dshape))
+            state.add_output(n, Ms[i], color)
+
+
+def _align_images_parallel(input_files, out_path, out_extension,
+                           landmark_finder, img_thresh, jobs, cache, state,
+                           reference, geometry, dedup_reduce, frame_store):
+    """
+    Parallel implementation of :func:`.align_images`.
+
+    Work is done in two passes over the pool. The first finds landmarks for
+    contiguous runs of input images, along with the distance of each image to
+    its predecessor. Duplicate detection, face filtering and selection of the
+    reference frame are then done serially so that the result is identical to
+    the serial implementation. The transformation of each selected frame is
+    then solved in one batch, and the second pass warps and writes the
+    selected frames.
+
+    """
+    chunk_size = max(1, len(input_files) // (jobs * 4))
+    if cache is not None:
+        cached = [cache.lookup(n) for n in input_files]
+    else:
+        cached = [None] * len(input_files)
+    chunks = [(input_files[i - 1] if i > 0 else state.prev_name,
+               input_files[i:i + chunk_size],
+               cached[i:i + chunk_size],
+               img_thresh,
+               dedup_reduce)
+                  for i in range(0, len(input_files), chunk_size)]
+
+    pool = multiprocessing.Pool(jobs,
+                                initializer=_init_worker,
+                                initargs=(landmark_finder,
+                                          profiler.enabled))
+    try:
+        stats = collections.Counter()
+        results = _scan_results(pool, chunks, stats)
+
+        # Replay the duplicate and face checks in input order.
+        selected = []
+        count = 0
+        total = 0
+        prev_name = state.prev_name
+        for i, (n, dist, lms, color) in enumerate(results):
+            total += 1
+            if prev_name is not None and img_thresh is not None:
+                if prev_name != (input_files[i - 1] if i > 0
+                                                    else state.prev_name):
+                    # The distance from the worker is to an image which was
+                    # itself dropped, so recompute it against the last image
+                    # kept.
+                    dist = dedup_distance(
+                                   _read_dedup_im(prev_name, dedup_reduce)[1],
+                                   _read_dedup_im(n, dedup_reduce)[1],
+                                   dedup_reduce)
+                if dist <= img_thresh:
+                    logger.debug("Ignoring %s as it is a duplicate", n)
+                    continue
+            count += 1
+            prev_name = n
+            state.kept.append(n)
+
+            if lms is None:
+                lms, color = _landmarks_and_color(landmark_finder,
+                                                  cv2.imread(n), cached[i])
+            if cache is not None and cached[i] is None:
+                cache.store(n, lms)
+            if lms is landmarks.NoFaces:
+                logger.warn("No faces in image %s", n)
+            elif lms is landmarks.TooManyFaces:
+                logger.warn("Too many faces in image %s", n)
+            else:
+                selected.append((n, lms, color))
+        logger.info("Read %s / %s images", count, total)
+        logger.info("Read %s images with landmarks", len(selected))
+        stats.update(landmark_finder.stats)
+        landmark_finder.log_stats(stats)
+
+        state.prev_name = prev_name
+        if not selected:
+            pool.close()
+            return
+        if reference == 'mean':
+            Ms, state.ref_landmarks, state.ref_color = _mean_reference(
+                                                                      selected)
+        else:
+            if state.ref_landmarks is None:
+                _, state.ref_landmarks, state.ref_color = selected[0]
+            Ms = procrustes.batch_procrustes(
+                        state.ref_landmarks,
+                        numpy.array([lms for n, lms, color in selected]))
+        if state.ref_shape is None:
+            state.ref_shape = cv2.imread(selected[0][0]).shape
+        A, dshape = output_transform(state.ref_landmarks, state.ref_shape,
+                                     **geometry)
+        if A is not None:
+            Ms = numpy.matmul(Ms, A)
+        items = [(n, M, color,
+                  os.path.join(out_path,
+                               "{:08d}.{}".format(state.next_idx + idx,
+                                                  out_extension)))
+                    for idx, ((n, lms, color), M) in enumerate(zip(selected,
+                                                                   Ms))]
+        writer = None
+        if frame_store is not None:
+            writer = framestore.FrameStoreWriter(out_path, frame_store)
+        # Chunks are added to the frame store in order, so results are
+        # collected in order.
+        for events, chunks in pool.imap(
+                _write_chunk,
+                [(c, state.ref_color, dshape, frame_store)
+                    for c in _chunks(items, chunk_size)]):
+            profiler.merge(events)
+            for chunk, entries in chunks or []:
+                writer.add_chunk(chunk, entries)
+        if writer is not None:
+            writer.close()
+        for (n, lms, color), M in zip(selected, Ms):
+            state.add_output(n, M, color)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
 def align_images(input_files, out_path, out_extension, landmark_finder,
-                 img_thresh=0.0):
+                 img_thresh=0.0, jobs=1, cache=None, incremental=False,
+                 dedup_mode='l2', hash_thresh=4, decode_threads=1,
+                 write_threads=1, queue_depth=4, reference='first',
+                 out_width=None, out_height=None, crop=None,
+                 dedup_reduce=1, shard=None, reference_file=None,
+                 frame_store=None):
     """
     Align a set of images of a person's face.
 
@@ -147,44 +1042,443 @@ def align_images(input_files, out_path, out_extension, landmark_finder,
     :param img_thresh:
 
         Images with an with this distance of the previous image (using the L2
-        norm) are considered duplicates and are ignored.
+        norm) are considered duplicates and are ignored. Only used when
+        `dedup_mode` is `'l2'`.
+
+    :param jobs:
+
+        Number of worker processes to use. Each worker loads its own copy of
+        the landmark finder. The output is identical to that of a serial run,
+        unless the landmark finder tracks faces: tracking then restarts at the
+        start of each chunk of input images, so landmarks may differ slightly
+        from a serial run, although they are the same from one parallel run
+        to the next.
+
+    :param cache:
+
+        An optional :class:`.LandmarkCache`. Landmarks for input files which
+        are in the cache are not recomputed, and newly found landmarks are
+        added to it.
+
+    :param incremental:
+
+        If set, and a manifest from a previous run exists in `out_path`, only
+        process input files which have been added since that run. This is only
+        possible if the previous run's input files are a prefix of
+        `input_files`, and no settings have changed, in which case the output
+        is identical to that of a full run. Otherwise all images are
+        processed.
+
+    :param dedup_mode:
+
+        Either `'l2'` to drop images which are within `img_thresh` of the
+        previous image, or `'hash'` to drop images which are within
+        `img_thresh` of any earlier image whose perceptual hash is within
+        `hash_thresh` bits of theirs. In `'hash'` mode duplicates are found in
+        a pre-pass over reduced resolution decodes, so they are never fully
+        decoded.
+
+    :param hash_thresh:
+
+        Maximum number of differing hash bits for two images to be considered
+        duplicates, when `dedup_mode` is `'hash'`.
+
+    :param decode_threads:
+
+        Number of threads which read input images ahead of landmark detection.
+        0 reads each image when it is needed.
+
+    :param write_threads:
+
+        Number of threads which encode and write aligned images. 0 writes each
+        image as soon as it is aligned.
+
+    :param queue_depth:
+
+        Maximum number of images waiting to be processed, and waiting to be
+        written. This bounds the memory used by the decode and write threads.
+
+        `decode_threads`, `write_threads` and `queue_depth` only apply when
+        `jobs` is 1. The output does not depend on them.
+
+    :param reference:
+
+        `'first'` to align every image to the face in the first image, or
+        `'mean'` to align every image to a mean face found by generalized
+        Procrustes analysis of all the images' landmarks. The reference colour
+        is then the mean face colour too. With `'mean'` each image is read
+        twice, and incremental runs are not possible, since a new image
+        changes the mean.
+
+    :param out_width:
+
+        Width of the aligned images. See :func:`.output_transform`.
+
+    :param out_height:
+
+        Height of the aligned images. See :func:`.output_transform`.
+
+    :param crop:
+
+        If given, aligned images are cropped to a box around the reference
+        face, this many times the size of the face. See
+        :func:`.output_transform`.
+
+    :param dedup_reduce:
+
+        Decode images at 1/`dedup_reduce` resolution (1, 2, 4 or 8) to compare
+        them with the previous image in `'l2'` mode. Images dropped as
+        duplicates are then never decoded in full. Distances are scaled to
+        approximate full resolution distances, so `img_thresh` need not
+        change.
+
+    :param shard:
+
+        Optional `(i, count)` tuple, with `0 <= i < count`. Only the i'th of
+        `count` contiguous runs of `input_files` is aligned, and the results
+        are written to the directory returned by :func:`.shard_path` within
+        `out_path`. Once every shard has been aligned, :func:`.merge_shards`
+        combines them.
+
+    :param reference_file:
+
+        Optional file written by :func:`.write_reference`, holding the
+        reference landmarks and colour to align to. This is required when
+        aligning more than one shard, so that every shard uses the same
+        reference.
+
+    :param frame_store:
+
+        If set to `'raw'` or `'png'`, aligned images are written to a
+        :class:`.FrameStore` in `out_path`, compressed as given, instead of to
+        one file per image. `out_extension` is then only used to name frames
+        within the store.
+
+    Returns the number of images which were aligned.
 
     """
-    ref_landmarks = None
-    ref_color = None
-    prev_masked_ims = []
+    if reference not in ('first', 'mean'):
+        raise Exception("Unknown reference {}".format(reference))
+    if reference_file is not None and reference == 'mean':
+        raise Exception("A reference file cannot be used when aligning to "
+                        "the mean face")
+    if frame_store not in (None,) + framestore.COMPRESSIONS:
+        raise Exception("Unknown frame store compression {}".format(
+                                                                 frame_store))
 
-    # Clean up the out_path, or create it it if necessary.
-    if os.path.exists(out_path):
-        if not os.path.isdir(out_path):
-            raise Exception("Path {} exists, but it is not a directory".format(
-                                                                     out_path))
-        logger.info("%s already exists. Removing existing images.", out_path)
-        for fname in glob.glob(os.path.join(out_path,
-                                            "*.{}".format(out_extension))):
-            os.remove(fname)
+    all_files = input_files
+    if shard is not None:
+        i, count = shard
+        if not 0 <= i < count:
+            raise Exception("Invalid shard {}/{}".format(i, count))
+        if count > 1 and reference_file is None:
+            raise Exception("Aligning in shards requires a reference file")
+        input_files = input_files[len(input_files) * i // count:
+                                  len(input_files) * (i + 1) // count]
+        out_path = shard_path(out_path, i, count)
+        logger.info("Aligning shard %s of %s (%s images) into %s",
+                    i, count, len(input_files), out_path)
+    settings = {'img_thresh': img_thresh, 'out_extension': out_extension,
+                'dedup_mode': dedup_mode, 'hash_thresh': hash_thresh,
+                'reference': reference, 'out_width': out_width,
+                'out_height': out_height, 'crop': crop,
+                'dedup_reduce': dedup_reduce,
+                'reference_file': reference_file,
+                'frame_store': frame_store}
+    resumed = None
+    if incremental and reference == 'mean':
+        logger.info("Incremental runs are not possible when aligning to the "
+                    "mean face. Processing all images.")
+    elif incremental and os.path.isdir(out_path):
+        resumed = _read_manifest(out_path, settings, input_files)
+
+    manifest_path = os.path.join(out_path, MANIFEST_NAME)
+    # Image hashes only depend on the files, so hashes from the last run are
+    # reused even if its other settings differ.
+    hashes = {}
+    if dedup_mode == 'hash':
+        if reference_file is not None:
+            hashes.update(_read_hashes(reference_file))
+        hashes.update(_read_hashes(manifest_path))
+    if resumed is not None:
+        state, new_files = resumed
+        logger.info("Resuming from manifest. %s new images, starting at %s.",
+                    len(new_files), state.next_idx)
+        # Remove the manifest while processing, so that an interrupted run is
+        # not resumed from.
+        os.remove(manifest_path)
     else:
-        logger.info("%s does not exist. Creating it.", out_path)
-        os.mkdir(out_path)
-
-    # Process each file in turn.
-    ims_and_landmarks = get_ims_and_landmarks(
-                                  read_ims(input_files, img_thresh=img_thresh),
-                                  landmark_finder)
-    for idx, (n, im, lms) in enumerate(ims_and_landmarks):
-        mask = landmarks.get_face_mask(im.shape, lms)
-        masked_im = mask[:, :, numpy.newaxis] * im
-        color = ((numpy.sum(masked_im, axis=(0, 1)) /
-                  numpy.sum(mask, axis=(0, 1))))
-        if ref_landmarks is None:  
-            ref_landmarks = lms
-        if ref_color is None:
-            ref_color = color
-        M = orthogonal_procrustes(ref_landmarks, lms)
-        warped = warp_im(im, M, im.shape)
-        warped_corrected = warped * ref_color / color
-        out_fname = os.path.join(out_path,
+        state, new_files = _AlignState(), input_files
+        if reference_file is not None:
+            _read_reference(reference_file, state)
+
+        # Clean up the out_path, or create it it if necessary.
+        if os.path.exists(out_path):
+            if not os.path.isdir(out_path):
+                raise Exception(
+                    "Path {} exists, but it is not a directory".format(
+                                                                     out_path))
+            logger.info("%s already exists. Removing existing images.",
+                        out_path)
+            for fname in glob.glob(os.path.join(out_path,
+                                                "*.{}".format(out_extension))):
+                os.remove(fname)
+            for fname in (MANIFEST_NAME, MASK_NAME, METADATA_NAME):
+                if os.path.exists(os.path.join(out_path, fname)):
+                    os.remove(os.path.join(out_path, fname))
+            framestore.remove_frame_store(out_path)
+        else:
+            logger.info("%s does not exist. Creating it.", out_path)
+            os.makedirs(out_path)
+
+    if dedup_mode == 'hash':
+        # Hash all inputs even when aligning a shard, so that duplicates of
+        # images in other shards are found too.
+        dups = dedup.find_duplicates(all_files, hash_thresh, hashes,
+                                     hash_duplicate_check(img_thresh))
+        new_files = [n for n in new_files if n not in dups]
+        img_thresh = None
+    elif dedup_mode != 'l2':
+        raise Exception("Unknown dedup mode {}".format(dedup_mode))
+    geometry = {'width': out_width, 'height': out_height, 'crop': crop}
+
+    start_time = time.time()
+    start_idx = state.next_idx
+    try:
+        if jobs > 1:
+            _align_images_parallel(new_files, out_path, out_extension,
+                                   landmark_finder, img_thresh, jobs, cache,
+                                   state, reference, geometry, dedup_reduce,
+                                   frame_store)
+        else:
+            _align_images_serial(new_files, out_path, out_extension,
+                                 landmark_finder, img_thresh, cache, state,
+                                 decode_threads, write_threads, queue_depth,
+                                 reference, geometry, dedup_reduce,
+                                 frame_store)
+    finally:
+        if cache is not None:
+            cache.save()
+
+    _write_manifest(out_path, settings,
+                    [_file_stamp(n) for n in input_files], state, shard,
+                    _hash_entries(all_files, hashes))
+    _write_metadata(out_path, settings, state)
+
+    elapsed = time.time() - start_time
+    count = state.next_idx - start_idx
+    logger.info("Aligned %s images in %.1f s (%.3f s per image)",
+                count, elapsed, elapsed / max(count, 1))
+    logger.info("Peak RSS %.0f MB (worker processes %.0f MB)",
+                _peak_rss_mb(), _peak_rss_mb(resource.RUSAGE_CHILDREN))
+    return count
+
+
+def _read_reference(fname, state):
+    with open(fname) as f:
+        d = json.load(f)
+    state.ref_landmarks = numpy.matrix(d['ref_landmarks'])
+    state.ref_color = numpy.array(d['ref_color'])
+    state.ref_shape = tuple(d['ref_shape'])
+
+
+def write_reference(fname, input_files, landmark_finder, cache=None,
+                    hash_images=False):
+    """
+    Find the reference face, and write it to `fname` for use by
+    :func:`.align_images`.
+
+    The reference is the first image in `input_files` which contains exactly
+    one face, as for a single unsharded run of :func:`.align_images`.
+
+    If `hash_images` is set, the hash of every input image is written to
+    `fname` too, for `'hash'` dedup mode. Shards which use the reference then
+    do not each have to hash every input.
+
+    """
+    ims_and_landmarks = get_ims_and_landmarks(read_ims(input_files, None),
+                                              landmark_finder, cache)
+    try:
+        n, im, lms = next(ims_and_landmarks)
+    except StopIteration:
+        raise Exception("No images with a face")
+    finally:
+        ims_and_landmarks.close()
+        if cache is not None:
+            cache.save()
+
+    hashes = {}
+    if hash_images:
+        hashes = dict((name, dedup.image_hash(name))
+                          for name in input_files)
+        logger.info("Hashed %s images", len(hashes))
+
+    with open(fname, 'w') as f:
+        json.dump({'name': n,
+                   'ref_landmarks': numpy.asarray(lms).tolist(),
+                   'ref_color': face_color(im, lms).tolist(),
+                   'ref_shape': list(im.shape),
+                   'hashes': _hash_entries(input_files, hashes)}, f)
+    logger.info("Wrote reference face from %s to %s", n, fname)
+
+
+def shard_path(out_path, i, count):
+    """
+    Return the directory within `out_path` that shard `i` of `count` is
+    written to.
+
+    """
+    return os.path.join(out_path, "shard-{:04d}-of-{:04d}".format(i, count))
+
+
+def merge_shards(out_path, landmark_finder=None, cache=None):
+    """
+    Combine the shards written to `out_path` by :func:`.align_images` into a
+    single sequence of aligned images in `out_path`.
+
+    The images are renumbered to be contiguous, and a manifest is written so
+    that later incremental runs can continue from the merged output.
+
+    Each shard checks for duplicates only among its own images, starting from
+    its first image. In `'l2'` dedup mode the duplicate checks at the start
+    of each shard are therefore replayed here, starting from the last image
+    kept before the shard, until they agree with the shard's own decisions.
+    Images which the shard dropped but an unsharded run would have kept are
+    aligned here with `landmark_finder` (and `cache`), so that the result is
+    the same as that of an unsharded run. (In `'hash'` mode every shard
+    already checks against all inputs.)
+
+    """
+    shard_dirs = sorted(glob.glob(os.path.join(out_path, _SHARD_GLOB)))
+    if not shard_dirs:
+        raise Exception("No shards found in {}".format(out_path))
+    manifests = []
+    for shard_dir in shard_dirs:
+        try:
+            with open(os.path.join(shard_dir, MANIFEST_NAME)) as f:
+                manifests.append(json.load(f))
+        except IOError:
+            raise Exception("Shard {} has not finished".format(shard_dir))
+        if 'kept' not in manifests[-1]:
+            raise Exception("Shard {} does not record its duplicates. "
+                            "Align it again.".format(shard_dir))
+
+    count = manifests[0]['shard'][1]
+    if [m['shard'] for m in manifests] != [[i, count] for i in range(count)]:
+        raise Exception("Expected {} shards in {}".format(count, out_path))
+    settings = manifests[0]['settings']
+    if any(m['settings'] != settings for m in manifests):
+        raise Exception("Shards were aligned with different settings")
+
+    out_extension = settings['out_extension']
+    frame_store = settings.get('frame_store')
+    manifest_path = os.path.join(out_path, MANIFEST_NAME)
+    for fname in glob.glob(os.path.join(out_path,
+                                        "*.{}".format(out_extension))):
+        os.remove(fname)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    framestore.remove_frame_store(out_path)
+    writer = None
+    if frame_store is not None:
+        writer = framestore.FrameStoreWriter(out_path, frame_store)
+
+    img_thresh = settings['img_thresh']
+    if settings['dedup_mode'] != 'l2':
+        img_thresh = None
+    dedup_reduce = settings.get('dedup_reduce', 1)
+    geometry = {'width': settings['out_width'],
+                'height': settings['out_height'],
+                'crop': settings['crop']}
+
+    state = _AlignState()
+    inputs = []
+    hashes = {}
+    for shard_dir, m in zip(shard_dirs, manifests):
+        shard_state = _state_from_dict(m)
+        shard_inputs = [stamp[0] for stamp in m['inputs']]
+        inputs.extend(m['inputs'])
+        hashes.update(m.get('hashes', {}))
+        if shard_state.ref_landmarks is not None:
+            state.ref_landmarks = shard_state.ref_landmarks
+            state.ref_color = shard_state.ref_color
+            state.ref_shape = shard_state.ref_shape
+
+        # Replay the duplicate checks from the last image kept so far, until
+        # an image is kept which the shard kept too. From there on the
+        # shard's decisions are the same as an unsharded run's. `sync` is the
+        # index of that image, and `missing` holds the images kept before it.
+        kept = set(shard_state.kept)
+        sync = 0
+        missing = []
+        if state.prev_name is not None and img_thresh is not None:
+            prev_name = state.prev_name
+            prev_im = _read_dedup_im(prev_name, dedup_reduce)[1]
+            for sync, n in enumerate(shard_inputs):
+                im = _read_dedup_im(n, dedup_reduce)[1]
+                if dedup_distance(prev_im, im, dedup_reduce) <= img_thresh:
+                    logger.info("Ignoring %s as it is a duplicate of %s",
+                                n, prev_name)
+                    continue
+                if n in kept:
+                    break
+                missing.append(n)
+                prev_name, prev_im = n, im
+            else:
+                sync = len(shard_inputs)
+
+        if missing:
+            if landmark_finder is None:
+                raise Exception("A landmark finder is needed to align images "
+                                "dropped by shard {}".format(shard_dir))
+            logger.info("Aligning %s images dropped by shard %s",
+                        len(missing), shard_dir)
+            if writer is not None:
+                writer.close()
+            _align_images_serial(missing, out_path, out_extension,
+                                 landmark_finder, None, cache, state, 0, 1, 4,
+                                 'first', geometry, 1, frame_store)
+            if writer is not None:
+                writer = framestore.FrameStoreWriter(out_path, frame_store)
+
+        synced = set(shard_inputs[sync:])
+        names = []
+        for idx, n in enumerate(shard_state.outputs):
+            fname = os.path.join(shard_dir,
                                  "{:08d}.{}".format(idx, out_extension))
-        cv2.imwrite(out_fname, warped_corrected)
-        logger.debug("Wrote file %s", out_fname)
+            new_fname = os.path.join(out_path,
+                                     "{:08d}.{}".format(state.next_idx,
+                                                        out_extension))
+            if n not in synced:
+                if writer is None:
+                    os.remove(fname)
+                continue
+            if writer is None:
+                os.rename(fname, new_fname)
+            else:
+                names.append((fname, new_fname))
+            state.outputs.append(n)
+            state.transforms.append(shard_state.transforms[idx])
+            state.color_scales.append(shard_state.color_scales[idx])
+            state.next_idx += 1
+        state.kept.extend(n for n in shard_state.kept if n in synced)
+        if sync < len(shard_inputs):
+            state.prev_name = shard_state.prev_name
+
+        if writer is not None:
+            writer.adopt(framestore.FrameStore(shard_dir),
+                         [old for old, _ in names],
+                         [new for _, new in names])
+            framestore.remove_frame_store(shard_dir)
+        for fname in (MANIFEST_NAME, MASK_NAME, METADATA_NAME):
+            if os.path.exists(os.path.join(shard_dir, fname)):
+                os.remove(os.path.join(shard_dir, fname))
+        os.rmdir(shard_dir)
 
+    if writer is not None:
+        writer.close()
+    if cache is not None:
+        cache.save()
+    _write_manifest(out_path, settings, inputs, state, hashes=hashes)
+    _write_metadata(out_path, settings, state)
+    logger.info("Merged %s shards into %s images", count, state.next_idx)
@@ -0,0 +1,173 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+__all__ = (
+    'LandmarkCache',
+)
+
+
+import hashlib
+import json
+import os
+
+import numpy
+
+from . import landmarks
+from .logging import logger
+
+
+_CACHE_VERSION = 1
+
+_ERRORS = {
+    'NoFaces': landmarks.NoFaces,
+    'TooManyFaces': landmarks.TooManyFaces,
+}
+
+
+def _file_hash(fname):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class LandmarkCache(object):
+    """
+    Persistent index of the landmarks found in a set of image files.
+
+    Entries are keyed by absolute path, and are only considered valid if the
+    file's size and modification time (or, if `hash_contents` is set, its
+    SHA-1) still match. Each entry holds either the landmark matrix, or the
+    name of the exception that was raised when looking for landmarks. The
+    whole index is discarded if the landmark finder's settings change.
+
+    The index is stored as JSON at `path`, and is only written out when
+    :meth:`.save` is called.
+
+    """
+    def __init__(self, path, finder_settings, hash_contents=False):
+        self.path = path
+        self.finder_settings = dict(finder_settings)
+        self.finder_settings['predictor_path'] = os.path.abspath(
+                                             finder_settings['predictor_path'])
+        self.hash_contents = hash_contents
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        self._entries = {}
+
+        try:
+            with open(path) as f:
+                d = json.load(f)
+        except IOError:
+            logger.info("Landmark cache %s does not exist. Creating it.",
+                        path)
+        else:
+            if (d.get('version') == _CACHE_VERSION and
+                    d.get('finder_settings') == self.finder_settings):
+                self._entries = d['entries']
+            else:
+                logger.info("Landmark cache %s is stale. Discarding it.", path)
+
+    def _stamp(self, fname):
+        st = os.stat(fname)
+        stamp = {'size': st.st_size, 'mtime': st.st_mtime}
+        if self.hash_contents:
+            stamp['sha1'] = _file_hash(fname)
+        return stamp
+
+    def lookup(self, fname, stamp=None):
+        """
+        Return the cached result for `fname`.
+
+        The result is a landmark matrix, or one of :class:`.NoFaces` and
+        :class:`.TooManyFaces`. `None` is returned if there is no valid entry
+        for the file.
+
+        """
+        if stamp is None:
+            stamp = self._stamp(fname)
+        entry = self._entries.get(os.path.abspath(fname))
+        if entry is None or entry['stamp'] != stamp:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if 'error' in entry:
+            return _ERRORS[entry['error']]
+        return numpy.matrix(entry['landmarks'])
+
+    def store(self, fname, result, stamp=None):
+        """
+        Record the result of looking for landmarks in `fname`.
+
+        `result` is either a landmark matrix, or one of :class:`.NoFaces` and
+        :class:`.TooManyFaces`.
+
+        """
+        if stamp is None:
+            stamp = self._stamp(fname)
+        entry = {'stamp': stamp}
+        if isinstance(result, type):
+            entry['error'] = result.__name__
+        else:
+            entry['landmarks'] = numpy.asarray(result).tolist()
+        self._entries[os.path.abspath(fname)] = entry
+        self._dirty = True
+
+    def get(self, fname, im, landmark_finder):
+        """
+        Get the landmarks for image `im` which was read from `fname`,
+        consulting the cache before running `landmark_finder`.
+
+        Raises :class:`.NoFaces` or :class:`.TooManyFaces` in the same way as
+        :meth:`.LandmarkFinder.get`. On a cache hit the landmark finder's
+        tracking is reset, as it has not seen `im`.
+
+        """
+        stamp = self._stamp(fname)
+        result = self.lookup(fname, stamp)
+        if result is None:
+            try:
+                result = landmark_finder.get(im)
+            except (landmarks.NoFaces, landmarks.TooManyFaces) as e:
+                result = type(e)
+            self.store(fname, result, stamp)
+        else:
+            landmark_finder.reset_tracking()
+
+        if isinstance(result, type):
+            raise result
+        return result
+
+    def save(self):
+        if not self._dirty:
+            return
+        logger.info("Writing landmark cache %s (%s hits, %s misses)",
+                    self.path, self.hits, self.misses)
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': _CACHE_VERSION,
+                       'finder_settings': self.finder_settings,
+                       'entries': self._entries}, f)
+        os.rename(tmp_path, self.path)
+        self._dirty = False
@@ -0,0 +1,58 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+__all__ = (
+    'imread',
+    'STAGES',
+)
+
+
+import cv2
+
+
+# Stages which can be configured to use reduced resolution decodes, with the
+# `reduced_decode` config option.
+STAGES = ('dedup', 'framedrop')
+
+_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def imread(fname, reduce=1):
+    """
+    Decode the colour image in `fname`, at 1/`reduce` of its full width and
+    height.
+
+    `reduce` may be 1, 2, 4 or 8. JPEGs are scaled while decoding, which skips
+    most of the work of a full decode. Other formats are decoded in full and
+    then shrunk.
+
+    """
+    if reduce not in _FLAGS:
+        raise Exception("Cannot decode at 1/{} resolution".format(reduce))
+    im = cv2.imread(fname, _FLAGS[reduce])
+    if im is None:
+        raise IOError("Could not read image {}".format(fname))
+    return im
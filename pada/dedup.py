@@ -0,0 +1,169 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+__all__ = (
+    'find_duplicates',
+    'image_hash',
+)
+
+
+import collections
+
+import cv2
+
+from .logging import logger
+from .timing import profiler
+
+
+HASH_BITS = 64
+
+# Images are hashed from decodes at 1/`HASH_REDUCE` resolution.
+HASH_REDUCE = 8
+
+
+@profiler.timed('dedup.hash')
+def image_hash(fname):
+    """
+    Return a 64-bit difference hash of the image in `fname`.
+
+    The image is decoded in greyscale at 1/8 resolution, shrunk to 9x8 pixels,
+    and each bit of the hash records whether a pixel is brighter than its
+    right-hand neighbour.
+
+    """
+    im = cv2.imread(fname, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if im is None:
+        raise IOError("Could not read image {}".format(fname))
+    thumb = cv2.resize(im, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (thumb[:, 1:] > thumb[:, :-1]).ravel()
+
+    h = 0
+    for b in bits:
+        h = (h << 1) | int(b)
+    return h
+
+
+def _hamming(h1, h2):
+    return bin(h1 ^ h2).count('1')
+
+
+class _HashIndex(object):
+    """
+    Index of hashes which supports finding any hash within `thresh` bits of a
+    query.
+
+    The hash is split into `thresh + 1` bands. Two hashes which differ in at
+    most `thresh` bits must agree exactly on at least one band, so only
+    entries sharing a band with the query need to be compared.
+
+    """
+    def __init__(self, thresh):
+        self.thresh = thresh
+        num_bands = min(thresh + 1, HASH_BITS)
+        self._band_edges = [HASH_BITS * i // num_bands
+                                for i in range(num_bands + 1)]
+        self._bands = [collections.defaultdict(list)
+                           for _ in range(num_bands)]
+
+    def _band_keys(self, h):
+        for lo, hi in zip(self._band_edges[:-1], self._band_edges[1:]):
+            yield (h >> lo) & ((1 << (hi - lo)) - 1)
+
+    def candidates(self, h):
+        """
+        Return the values of the entries within `thresh` bits of `h`, nearest
+        first.
+
+        """
+        found = {}
+        for band, key in zip(self._bands, self._band_keys(h)):
+            for other_h, value in band[key]:
+                dist = _hamming(h, other_h)
+                if dist <= self.thresh:
+                    found[value] = dist
+        return sorted(found, key=lambda value: found[value])
+
+    def add(self, h, value):
+        for band, key in zip(self._bands, self._band_keys(h)):
+            band[key].append((h, value))
+
+
+def find_duplicates(names, hash_thresh, hashes=None, is_duplicate=None):
+    """
+    Find images which are near duplicates of an earlier image.
+
+    Every image is compared against all earlier images which are not
+    themselves duplicates, so re-imported photos and bursts are caught even
+    when they are not adjacent.
+
+    :param names:
+        Ordered list of image file names.
+
+    :param hash_thresh:
+        Maximum number of differing hash bits for two images to be considered
+        duplicates.
+
+    :param hashes:
+        Optional dict mapping file names to hashes which are already known, as
+        returned by :func:`.image_hash`. Only images missing from it are
+        decoded, and their hashes are added to it.
+
+    :param is_duplicate:
+        Optional function called as `is_duplicate(n, orig)`. Hashes of
+        consecutive photos are often close even when the photos differ, so if
+        this is given the hash only finds candidates, and `n` is only a
+        duplicate of a candidate `orig` for which this returns true.
+
+    :return:
+        Dict mapping each duplicate's file name to the name of the image it
+        duplicates.
+
+    """
+    if hashes is None:
+        hashes = {}
+    index = _HashIndex(hash_thresh)
+    dups = {}
+    num_hashed = 0
+    num_checked = 0
+    for n in names:
+        h = hashes.get(n)
+        if h is None:
+            h = hashes[n] = image_hash(n)
+            num_hashed += 1
+        orig = None
+        for candidate in index.candidates(h):
+            if is_duplicate is None:
+                orig = candidate
+                break
+            num_checked += 1
+            if is_duplicate(n, candidate):
+                orig = candidate
+                break
+        if orig is not None:
+            logger.debug("%s is a duplicate of %s", n, orig)
+            dups[n] = orig
+        else:
+            index.add(h, n)
+    logger.info("Found %s duplicates in %s images (%s newly hashed, %s "
+                "candidates checked)",
+                len(dups), len(names), num_hashed, num_checked)
+
+    return dups
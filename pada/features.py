@@ -0,0 +1,177 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+__all__ = (
+    'embed_features',
+    'load_features',
+    'read_features',
+    'read_image',
+    'reduce_mask',
+)
+
+
+import hashlib
+import json
+import os
+
+import cv2
+import numpy
+import numpy.lib.format
+
+from . import decode
+from .logging import logger
+from .timing import profiler
+
+
+_STORE_VERSION = 1
+
+
+def masked_vector(im, mask):
+    """
+    Pack the pixels of `im` which lie within `mask` into a flat uint8 vector.
+
+    """
+    return im[mask].ravel()
+
+
+def reduce_mask(mask, shape):
+    """
+    Resize boolean `mask` to the size of images of shape `shape`.
+
+    """
+    if mask.shape == tuple(shape[:2]):
+        return mask
+    return cv2.resize(mask.astype(numpy.uint8), (shape[1], shape[0]),
+                      interpolation=cv2.INTER_NEAREST).astype(bool)
+
+
+def read_image(name, reduce=1, frame_store=None):
+    """
+    Return the image `name` at 1/`reduce` resolution, read from the
+    :class:`.FrameStore` `frame_store` if one is given, or else decoded from
+    the file `name`.
+
+    """
+    if frame_store is not None:
+        return frame_store.read(name, reduce)
+    return decode.imread(name, reduce)
+
+
+def read_features(names, mask, reduce=1, frame_store=None):
+    """
+    Decode each image in `names`, and yield its masked pixel vector.
+
+    Images are decoded at 1/`reduce` resolution, in which case `mask` should
+    have been resized to match with :func:`.reduce_mask`. If a
+    :class:`.FrameStore` is given the images are read from it.
+
+    """
+    for n in names:
+        logger.debug("Reading image %s", n)
+        with profiler.stage('framedrop.decode'):
+            v = masked_vector(read_image(n, reduce, frame_store), mask)
+        yield v
+
+
+def _store_key(names, mask, erode_amount, reduce, frame_store):
+    if frame_store is not None:
+        inputs = [frame_store.stamp(n) for n in names]
+    else:
+        inputs = [[n, os.stat(n).st_size, os.stat(n).st_mtime]
+                      for n in names]
+    return {
+        'version': _STORE_VERSION,
+        'reduce': reduce,
+        'mask_sha1': hashlib.sha1(
+                           numpy.packbits(mask).tobytes()).hexdigest(),
+        'mask_shape': list(mask.shape),
+        'erode_amount': erode_amount,
+        'inputs': inputs,
+    }
+
+
+def load_features(names, mask, erode_amount, store_path, reduce=1,
+                  frame_store=None):
+    """
+    Return an `(N, D)` uint8 array holding the masked pixel vector of each
+    image in `names`.
+
+    The array is a read-only memory map of the `.npy` file at `store_path`.
+    The file is reused if it was built from the same images (by path, size and
+    modification time) and the same mask, `erode_amount` and `reduce`, and is
+    rebuilt otherwise. `reduce` and `frame_store` are as for
+    :func:`.read_features`.
+
+    """
+    key = _store_key(names, mask, erode_amount, reduce, frame_store)
+    key_path = "{}.json".format(store_path)
+    try:
+        with open(key_path) as f:
+            valid = (json.load(f) == key)
+    except IOError:
+        valid = False
+
+    if valid:
+        logger.info("Reusing feature store %s", store_path)
+    else:
+        logger.info("Building feature store %s", store_path)
+        if os.path.exists(key_path):
+            os.remove(key_path)
+        features = numpy.lib.format.open_memmap(
+                               store_path, mode='w+', dtype=numpy.uint8,
+                               shape=(len(names), 3 * int(numpy.sum(mask))))
+        for i, v in enumerate(read_features(names, mask, reduce,
+                                            frame_store)):
+            features[i] = v
+        features.flush()
+        del features
+
+        # Only write the key once the store is complete, so that an
+        # interrupted build is not reused.
+        with open(key_path, 'w') as f:
+            json.dump(key, f)
+
+    return numpy.load(store_path, mmap_mode='r')
+
+
+def embed_features(vecs, dim, out_dim, seed=0):
+    """
+    Project each of the `dim` long vectors in `vecs` down to `out_dim`
+    dimensions, and return the results as the rows of an array.
+
+    Each input dimension is added to one randomly chosen output dimension,
+    with a random sign (a "count sketch"). Distances between the projected
+    vectors are then unbiased estimates of the distances between the original
+    vectors, with a relative error that shrinks as `out_dim` grows. Unlike a
+    dense random projection no `dim` by `out_dim` matrix is needed, and each
+    vector is projected in a single pass over its elements.
+
+    """
+    r = numpy.random.RandomState(seed)
+    buckets = r.randint(out_dim, size=dim)
+    signs = r.randint(2, size=dim) * 2. - 1.
+
+    out = []
+    for v in vecs:
+        with profiler.stage('framedrop.embed'):
+            out.append(numpy.bincount(buckets, weights=signs * v,
+                                      minlength=out_dim).astype(numpy.float32))
+    return numpy.array(out)
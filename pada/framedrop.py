@@ -22,7 +22,11 @@
 
 
 __all__ = (
+    'band_distances',
     'filter_files',
+    'select_frames',
+    'sweep_files',
+    'sweep_frames',
 )
 
 
@@ -33,40 +37,405 @@ import os
 import cv2
 import numpy
 
+from . import features
 from . import landmarks
 from .logging import logger
+from .timing import profiler
 
 
-def find_weights(names, mask, frame_skip):
-    weights = collections.defaultdict(dict) 
+@profiler.timed('framedrop.distance')
+def layer_distances(vecs1, sq1, vecs2, sq2):
+    """
+    Return the matrix of L2 distances between each row of `vecs1` and each row
+    of `vecs2`.
+
+    `sq1` and `sq2` are the squared norms of the rows. The distances are
+    computed as `sqrt(|a|^2 + |b|^2 - 2 a.b)`, so that all of the work is done
+    by a single matrix product.
+
+    """
+    d2 = sq1[:, numpy.newaxis] + sq2[numpy.newaxis, :] - 2. * numpy.dot(
+                                                                vecs1, vecs2.T)
+    return numpy.sqrt(numpy.maximum(d2, 0.))
+
+
+def _as_rows(vecs):
+    """
+    Stack a list of uint8 vectors into a float64 matrix, and return it along
+    with the squared norm of each row.
+
+    """
+    rows = numpy.vstack(vecs).astype(numpy.float64)
+    return rows, numpy.einsum('ij,ij->i', rows, rows)
+
+
+def iter_weights(vecs, frame_skip):
+    """
+    Yield the distance between each frame and each frame in the next layer.
+
+    `vecs` is an iterable holding the masked pixel vector of each frame. The
+    frames are split into layers of `frame_skip` frames (the last layer may be
+    shorter), and for each pair of consecutive layers the matrix of distances
+    between their frames is yielded. Only two layers of vectors are held at
+    a time.
+
+    """
     prev_layer = None
     layer = []
+    count = 0
 
-    def link_layers(layer1, layer2):
-        for n1, m1 in layer1:
-            for n2, m2 in layer2:
-                weights[n1][n2] = numpy.linalg.norm(m2 - m1)
-
-    for n in names:
-        im = cv2.imread(n)
-        masked_im = (im * mask[:, :, numpy.newaxis]).astype(numpy.float32)
-        layer.append((n, masked_im))
+    for v in vecs:
+        layer.append(v)
 
         if len(layer) == frame_skip:
+            layer = _as_rows(layer)
             if prev_layer is not None:
-                link_layers(prev_layer, layer)
+                yield layer_distances(*(prev_layer + layer))
+                count += 1
             prev_layer = layer
             layer = []
 
-    if layer:
-        link_layers(prev_layer, layer)
+    if layer and prev_layer is not None:
+        yield layer_distances(*(prev_layer + _as_rows(layer)))
+        count += 1
+
+    assert count, "Need at least {} input images".format(frame_skip + 1)
+
+
+def find_weights(vecs, frame_skip):
+    """
+    Return a list of the matrices yielded by :func:`.iter_weights`.
+
+    """
+    return list(iter_weights(vecs, frame_skip))
+
+
+def _layer_path(weights):
+    """
+    Find the shortest path through a layered graph.
+
+    `weights` is an iterable of distance matrices, as yielded by
+    :func:`.iter_weights`. Each matrix is folded into the shortest distances
+    as soon as it is produced and then dropped, so only the distances to the
+    current layer and a small array of back pointers per layer are kept. Any
+    frame in the first layer may start the path, and any frame in the last
+    layer may end it. Returns the frame indices on the path.
+
+    """
+    # `dist` gives the minimum distance from each frame in the current layer
+    # to a start frame, and `parents[k]` gives, for each frame in layer
+    # `k + 1`, the index within layer `k` of the previous frame on the
+    # shortest path to it.
+    dist = None
+    parents = []
+    for w in weights:
+        with profiler.stage('framedrop.solve'):
+            if dist is None:
+                layer_size = w.shape[0]
+                dist = numpy.zeros(layer_size)
+            cand = dist[:, numpy.newaxis] + w
+            parent = numpy.argmin(cand, axis=0)
+            dist = cand[parent, numpy.arange(w.shape[1])]
+            parents.append(parent.astype(numpy.min_scalar_type(layer_size)))
+
+    # Find the end frame which has least distance, and step back through the
+    # layers to a start frame.
+    j = int(numpy.argmin(dist))
+    path = [len(parents) * layer_size + j]
+    for k in reversed(range(len(parents))):
+        j = int(parents[k][j])
+        path.append(k * layer_size + j)
+
+    return list(reversed(path))
+
+
+def _steps(pred_start, block_start, block_end):
+    """
+    Return the matrix of steps from each of the frames `pred_start` to
+    `block_start` to each of the frames `block_start` to `block_end`.
+
+    """
+    return (numpy.arange(block_start, block_end)[numpy.newaxis, :] -
+            numpy.arange(pred_start, block_start)[:, numpy.newaxis])
+
+
+def _window_step(dist, parent, w, pred_start, block_start, skip_min,
+                 skip_max):
+    """
+    Fill in `dist` and `parent` for a block of frames starting at
+    `block_start`, given the distances `w` to them from the frames starting at
+    `pred_start`. `w` is modified.
+
+    """
+    block_end = block_start + w.shape[1]
+
+    # Only allow steps of between skip_min and skip_max frames.
+    step = _steps(pred_start, block_start, block_end)
+    w[(step < skip_min) | (step > skip_max)] = numpy.inf
+
+    cand = dist[pred_start:block_start, numpy.newaxis] + w
+    p = numpy.argmin(cand, axis=0)
+    dist[block_start:block_end] = cand[p, numpy.arange(w.shape[1])]
+    parent[block_start:block_end] = pred_start + p
+
+
+def _window_trace(dist, parent, skip_min):
+    """
+    Return the shortest path ending in one of the last `skip_min` frames.
+
+    """
+    j = len(dist) - skip_min + int(numpy.argmin(dist[-skip_min:]))
+    path = [j]
+    while parent[j] >= 0:
+        j = int(parent[j])
+        path.append(j)
+
+    return list(reversed(path))
+
+
+def band_distances(vecs, num_frames, width):
+    """
+    Return the distance from each frame to each of the `width` frames which
+    follow it.
+
+    `vecs` is an iterable holding the masked pixel vectors of the `num_frames`
+    frames, which is only read once. In the returned `(num_frames, width)`
+    array, element `[i, s - 1]` is the distance from frame `i` to frame
+    `i + s`. Elements for frames past the end are infinite.
+
+    """
+    band = numpy.full((num_frames, width), numpy.inf)
+
+    # Frames are processed in blocks of `width`. Each block is compared with
+    # itself and with the `width` frames before it, which are kept in
+    # `recent`.
+    recent = collections.deque(maxlen=width)
+    vecs = iter(vecs)
+    for block_start in range(0, num_frames, width):
+        block_end = min(block_start + width, num_frames)
+        block, block_sq = _as_rows([next(vecs)
+                                       for _ in range(block_start, block_end)])
+        pred_start = block_start - len(recent)
+        rows = numpy.vstack([v for v, sq in recent] + [block])
+        rows_sq = numpy.concatenate([[sq for v, sq in recent], block_sq])
+        w = layer_distances(rows, rows_sq, block, block_sq)
+
+        step = (numpy.arange(block_start, block_end)[numpy.newaxis, :] -
+                numpy.arange(pred_start, block_end)[:, numpy.newaxis])
+        i, j = numpy.nonzero((step >= 1) & (step <= width))
+        band[pred_start + i, step[i, j] - 1] = w[i, j]
+        recent.extend(zip(block, block_sq))
+
+    return band
+
+
+def _band_layer_path(band, frame_skip):
+    """
+    As :func:`._layer_path`, but taking the distances between layers from the
+    result of :func:`.band_distances`, which must be at least
+    `2 * frame_skip - 1` wide.
+
+    """
+    num_frames = band.shape[0]
+    assert num_frames > frame_skip, "Need at least {} input images".format(
+                                                                frame_skip + 1)
+    weights = []
+    for start in range(frame_skip, num_frames, frame_skip):
+        end = min(start + frame_skip, num_frames)
+        step = _steps(start - frame_skip, start, end)
+        weights.append(band[numpy.arange(start - frame_skip,
+                                         start)[:, numpy.newaxis],
+                            step - 1])
+    return _layer_path(weights)
+
+
+def _band_window_path(band, skip_min, skip_max, step_cost=0.):
+    """
+    Find the shortest path through the frames, where each step on the path
+    moves forward by between `skip_min` and `skip_max` frames, and costs
+    `step_cost` on top of the distance between its frames.
+
+    Distances are taken from the result of :func:`.band_distances`, which must
+    be at least `skip_max` wide. Any of the first `skip_min` frames may start
+    the path, and any of the last `skip_min` frames may end it. Returns the
+    frame indices on the path.
 
-    assert weights, "Need at least {} input images".format(frame_skip + 1)
+    """
+    num_frames = band.shape[0]
+    assert 0 < skip_min <= skip_max, "Need 0 < skip_min <= skip_max"
+    assert num_frames > skip_min, "Need at least {} input images".format(
+                                                                 skip_min + 1)
+
+    # Frames are processed in blocks of `skip_min`, so that all of a block's
+    # predecessors come before the block and already have a final distance.
+    dist = numpy.zeros(num_frames)
+    parent = numpy.full(num_frames, -1, dtype=numpy.int64)
+    for block_start in range(skip_min, num_frames, skip_min):
+        block_end = min(block_start + skip_min, num_frames)
+        pred_start = max(0, block_start - skip_max)
+        step = _steps(pred_start, block_start, block_end)
+        w = band[numpy.arange(pred_start, block_start)[:, numpy.newaxis],
+                 numpy.minimum(step, skip_max) - 1] + step_cost
+        _window_step(dist, parent, w, pred_start, block_start, skip_min,
+                     skip_max)
+
+    return _window_trace(dist, parent, skip_min)
+
+
+def _window_path(band, frame_skip, skip_min, skip_max, iterations=50):
+    """
+    Find a path as :func:`._band_window_path` does, which keeps about one in
+    every `frame_skip` frames.
+
+    Distances between frames grow more slowly than the step between them, so
+    the plain shortest path takes as few, long steps as it can. Instead
+    `step_cost` is searched for which gives the path the same number of
+    frames as `'layer'` mode would keep. More negative values of `step_cost`
+    give paths with more frames.
+
+    """
+    num_frames = band.shape[0]
+    target = len(range(0, num_frames, frame_skip))
+    finite = band[numpy.isfinite(band)]
+    # Any path costs less than `bound`, so with a step cost of `-bound` the
+    # path with the most steps is chosen, and with `bound` the fewest.
+    bound = (float(numpy.max(finite)) if len(finite) else 0.) * num_frames + 1.
+    lo, hi = -bound, bound
+    best = None
+    for _ in range(iterations):
+        step_cost = 0.5 * (lo + hi)
+        path = _band_window_path(band, skip_min, skip_max, step_cost)
+        if best is None or abs(len(path) - target) < abs(len(best) - target):
+            best = path
+        if len(path) == target:
+            break
+        elif len(path) > target:
+            lo = step_cost
+        else:
+            hi = step_cost
+    return best
+
+
+def path_cost(vecs):
+    """
+    Return the total distance between consecutive vectors in `vecs`.
+
+    """
+    rows, _ = _as_rows(vecs)
+    return float(numpy.sum(numpy.sqrt(numpy.sum(numpy.diff(rows, axis=0) ** 2,
+                                                axis=1))))
+
+
+def select_frames(vecs, num_frames, frame_skip, mode='layer', skip_min=None,
+                  skip_max=None):
+    """
+    Choose a subset of frames which minimizes the total frame difference.
+
+    `vecs` is an iterable of the masked pixel vectors of the `num_frames`
+    frames. The remaining arguments are as for :func:`.filter_files`. Returns
+    the indices of the chosen frames.
+
+    """
+    if mode == 'layer':
+        logger.debug("Computing distances")
+        return _layer_path(iter_weights(vecs, frame_skip))
+    elif mode == 'window':
+        skip_min, skip_max = _window_skips(frame_skip, skip_min, skip_max)
+        logger.debug("Computing distances")
+        band = band_distances(vecs, num_frames, skip_max)
+        with profiler.stage('framedrop.solve'):
+            return _window_path(band, frame_skip, skip_min, skip_max)
+    else:
+        raise Exception("Unknown framedrop mode {}".format(mode))
+
+
+def _window_skips(frame_skip, skip_min, skip_max):
+    if skip_min is None:
+        skip_min = max(1, frame_skip // 2)
+    if skip_max is None:
+        skip_max = frame_skip + frame_skip // 2
+    return skip_min, skip_max
+
+
+def sweep_frames(vecs, num_frames, frame_skips, mode='layer', skip_min=None,
+                 skip_max=None):
+    """
+    Choose frames as :func:`.select_frames` does, for each of several values
+    of `frame_skip`, while only computing distances between frames once.
+
+    The distances from each frame to the frames following it, up to the
+    furthest step any of `frame_skips` allows, are found with
+    :func:`.band_distances`, and the shortest path for each setting is then
+    found from these.
 
-    return weights
+    Returns a list holding `(path, cost)` for each of `frame_skips`, where
+    `path` holds the indices of the chosen frames and `cost` is the total
+    distance along the path.
 
+    """
+    if mode == 'layer':
+        width = 2 * max(frame_skips) - 1
+    elif mode == 'window':
+        width = max(_window_skips(frame_skip, skip_min, skip_max)[1]
+                        for frame_skip in frame_skips)
+    else:
+        raise Exception("Unknown framedrop mode {}".format(mode))
+
+    logger.info("Computing distances to the next %s frames", width)
+    band = band_distances(vecs, num_frames, width)
+    results = []
+    for frame_skip in frame_skips:
+        with profiler.stage('framedrop.solve'):
+            if mode == 'layer':
+                path = _band_layer_path(band, frame_skip)
+            else:
+                path = _window_path(
+                          band, frame_skip,
+                          *_window_skips(frame_skip, skip_min, skip_max))
+        cost = float(numpy.sum(band[path[:-1], numpy.diff(path) - 1]))
+        results.append((path, cost))
+    return results
+
+
+def _report_approx(path, embedded, input_files, mask, decode_reduce,
+                   feature_store, frame_skip, mode, skip_min, skip_max,
+                   approx_check, frame_store):
+    """
+    Log how well the path found with :func:`.features.embed_features` matches
+    the exact distances.
 
-def make_mask(im_name, erode_amount, landmark_finder):
+    """
+    def percent(a, b):
+        # Relative difference of `a` from `b`, which may be 0 if the frames
+        # are identical.
+        return 100. * (a - b) / b if b else 0.
+
+    def exact_vecs(indices=None):
+        if feature_store is not None:
+            vecs = numpy.load(feature_store, mmap_mode='r')
+            return vecs if indices is None else vecs[indices]
+        names = input_files
+        if indices is not None:
+            names = [input_files[i] for i in indices]
+        return features.read_features(names, mask, decode_reduce,
+                                      frame_store)
+
+    estimated = path_cost(embedded[path])
+    cost = path_cost(list(exact_vecs(path)))
+    logger.info("Approximate path cost %.1f (estimated %.1f, %+.2f %%)",
+                cost, estimated, percent(estimated, cost))
+
+    if approx_check:
+        exact_path = select_frames(exact_vecs(), len(input_files), frame_skip,
+                                   mode, skip_min, skip_max)
+        exact_cost = path_cost(list(exact_vecs(exact_path)))
+        logger.info("Exact path cost %.1f. Approximate path is %.2f %% "
+                    "longer, and has %s / %s frames in common.",
+                    exact_cost, percent(cost, exact_cost),
+                    len(set(path) & set(exact_path)), len(exact_path))
+
+
+def make_mask(im_name, erode_amount, landmark_finder, cache=None):
     """
     Define a mask which is the eroded convex hull of the face in the given
     image.
@@ -76,14 +445,37 @@ def make_mask(im_name, erode_amount, landmark_finder):
 
     """
     im = cv2.imread(im_name)
-    lm = landmark_finder.get(im)
-    mask = landmarks.get_face_mask(im.shape, lm)
-    mask = cv2.GaussianBlur(mask, (erode_amount, erode_amount), 0) > 0.99
+    if cache is not None:
+        lm = cache.get(im_name, im, landmark_finder)
+        cache.save()
+    else:
+        lm = landmark_finder.get(im)
+    return eroded_face_mask(im.shape, lm, erode_amount)
+
 
-    return mask
+def eroded_face_mask(shape, lm, erode_amount):
+    """
+    Return a boolean mask of the convex hull of landmarks `lm`, eroded by
+    `erode_amount`.
+
+    """
+    return erode_mask(landmarks.get_face_mask(shape, lm), erode_amount)
+
+
+def erode_mask(mask, erode_amount):
+    """
+    Return a boolean mask of the pixels of `mask` which are not within about
+    `erode_amount / 2` pixels of its edge.
+
+    """
+    mask = numpy.asarray(mask, dtype=numpy.float64)
+    return cv2.GaussianBlur(mask, (erode_amount, erode_amount), 0) > 0.99
     
 
-def filter_files(input_files, frame_skip, erode_amount, landmark_finder):
+def filter_files(input_files, frame_skip, erode_amount, landmark_finder,
+                 cache=None, feature_store=None, mode='layer', skip_min=None,
+                 skip_max=None, decode_reduce=1, approx_dim=None,
+                 approx_check=False, face_mask=None, frame_store=None):
     """
     Filter video frames, minimizing total frame different.
 
@@ -100,51 +492,161 @@ def filter_files(input_files, frame_skip, erode_amount, landmark_finder):
         An instance of :class:`.LandmarkFinder`, used to find the facial
         landmarks.
 
+    :param cache:
+        An optional :class:`.LandmarkCache`, consulted before finding the
+        landmarks used to make the mask.
+
+    :param feature_store:
+        Optional path of a `.npy` file in which to keep the masked pixels of
+        each frame. It is reused by later runs with the same frames and mask,
+        which then do not need to decode any frames.
+
+    :param mode:
+        `'layer'` to split the frames into layers of `frame_skip` frames and
+        pick one frame from each layer, or `'window'` to allow each frame to be
+        followed by any frame between `skip_min` and `skip_max` frames later,
+        while still keeping about one in every `frame_skip` frames.
+
+    :param skip_min:
+        Minimum step between chosen frames in `'window'` mode. Defaults to
+        half of `frame_skip`.
+
+    :param skip_max:
+        Maximum step between chosen frames in `'window'` mode. Defaults to
+        one and a half times `frame_skip`.
+
+    :param decode_reduce:
+        Decode frames at 1/`decode_reduce` resolution (1, 2, 4 or 8) when
+        measuring frame differences. The mask is shrunk to match.
+
+    :param approx_dim:
+        If given, each frame's masked pixels are projected down to this many
+        dimensions with :func:`.features.embed_features`, and frames are
+        selected using distances between the projections. Larger values are
+        slower but more accurate. The exact cost of the chosen path is logged,
+        along with how far it differs from the cost estimated from the
+        projections.
+
+    :param approx_check:
+        When `approx_dim` is given, also select frames using exact distances,
+        and log how much longer the approximate path is than the exact one,
+        and how many frames they have in common.
+
+    :param face_mask:
+        Optional boolean mask of the face in the frames, as returned by
+        :func:`.align.read_face_mask`. If given it is eroded and used in place
+        of a mask made by finding the face in the first frame, so
+        `landmark_finder` is not used and may be `None`.
+
+    :param frame_store:
+        Optional :class:`.FrameStore` holding the frames, in which case
+        `input_files` are names of frames in the store, and `face_mask` must
+        be given.
+
     """
     input_files = list(input_files)
     logger.info("Filtering %s files", len(input_files))
+    mask, vecs = _frame_features(input_files, erode_amount, landmark_finder,
+                                 cache, feature_store, decode_reduce,
+                                 face_mask, frame_store)
 
-    # Make a mask, which defines the area over which frame difference is
-    # measured.
-    logger.debug("Making mask")
-    mask = make_mask(input_files[0], erode_amount, landmark_finder)
-
-    # Find the nodes in the first and last layer.
-    logger.debug("Finding weights")
-    weights = find_weights(input_files, mask, frame_skip)
-    sources = input_files[:frame_skip]
-    if len(input_files) % frame_skip != 0:
-        drains = input_files[-(len(input_files) % frame_skip):]
+    if approx_dim is None:
+        path = select_frames(vecs, len(input_files), frame_skip, mode,
+                             skip_min, skip_max)
     else:
-        drains = input_files[-frame_skip:]
-
-    # Compute `dist` which gives the minimum distance from any frame to a start
-    # frame, and `parent` which given a node returns the previous node on the
-    # shortest path to that node.
-    logger.debug("Computing distances")
-    dist = {n: (0 if n in sources else None) for n in input_files}
-    parent = {}
-    for u in input_files:
-        for v, weight in weights[u].items():
-            if dist[v] is None or dist[v] > dist[u] + weight:
-                dist[v] = dist[u] + weight
-                parent[v] = u
-
-    # Find the end node which has least distance, and step through the shortest
-    # path until we hit a start node.
-    def drain_to_source():
-        v = min(drains, key=lambda v: dist[v])
-        yield v
-        while v not in sources:
-            v = parent[v]
-            yield v
-
-    # Reverse to find the shortest path.
-    path = list(reversed(list(drain_to_source())))
-    for n in path:
-        yield n
+        logger.info("Projecting frames to %s dimensions", approx_dim)
+        embedded = features.embed_features(vecs, 3 * int(numpy.sum(mask)),
+                                           approx_dim)
+        path = select_frames(embedded, len(input_files), frame_skip, mode,
+                             skip_min, skip_max)
+        _report_approx(path, embedded, input_files, mask, decode_reduce,
+                       feature_store, frame_skip, mode, skip_min, skip_max,
+                       approx_check, frame_store)
+
+    for i in path:
+        yield input_files[i]
 
     logger.info("Kept %s / %s (%s %%) frames", 
                                            len(path), len(input_files),
                                            100. * len(path) / len(input_files))
 
+
+def _frame_features(input_files, erode_amount, landmark_finder, cache,
+                    feature_store, decode_reduce, face_mask, frame_store):
+    """
+    Return the eroded face mask, and the masked pixels of each frame.
+
+    """
+    # Make a mask, which defines the area over which frame difference is
+    # measured.
+    if face_mask is not None:
+        shape = features.read_image(input_files[0], 1, frame_store).shape
+        if shape[:2] != face_mask.shape:
+            raise Exception("Aligned images are {}x{}, but align wrote a face "
+                            "mask for {}x{} images. Run align again.".format(
+                                shape[1], shape[0], face_mask.shape[1],
+                                face_mask.shape[0]))
+        logger.debug("Eroding face mask")
+        mask = erode_mask(face_mask, erode_amount)
+    elif frame_store is not None:
+        raise Exception("A face mask is needed to filter frames in a frame "
+                        "store")
+    else:
+        logger.debug("Making mask")
+        mask = make_mask(input_files[0], erode_amount, landmark_finder, cache)
+    if decode_reduce != 1:
+        mask = features.reduce_mask(
+                      mask, features.read_image(input_files[0], decode_reduce,
+                                                frame_store).shape)
+
+    if feature_store is not None:
+        vecs = features.load_features(input_files, mask, erode_amount,
+                                      feature_store, decode_reduce,
+                                      frame_store)
+    else:
+        vecs = features.read_features(input_files, mask, decode_reduce,
+                                      frame_store)
+    return mask, vecs
+
+
+def sweep_files(input_files, frame_skips, erode_amount, landmark_finder,
+                cache=None, feature_store=None, mode='layer', skip_min=None,
+                skip_max=None, decode_reduce=1, approx_dim=None,
+                face_mask=None, frame_store=None):
+    """
+    Filter video frames as :func:`.filter_files` does, for each of several
+    values of `frame_skip`, reading the frames and computing the distances
+    between them only once. See :func:`.sweep_frames`.
+
+    :param frame_skips:
+        List of values of `frame_skip` to try.
+
+    The remaining parameters are as for :func:`.filter_files`, except that no
+    report is made when `approx_dim` is given.
+
+    Returns a list holding `(files, cost)` for each of `frame_skips`, where
+    `files` lists the chosen frames and `cost` is the total distance between
+    consecutive chosen frames.
+
+    """
+    input_files = list(input_files)
+    logger.info("Filtering %s files with frame_skip %s", len(input_files),
+                ", ".join(str(k) for k in frame_skips))
+    mask, vecs = _frame_features(input_files, erode_amount, landmark_finder,
+                                 cache, feature_store, decode_reduce,
+                                 face_mask, frame_store)
+    if approx_dim is not None:
+        logger.info("Projecting frames to %s dimensions", approx_dim)
+        vecs = features.embed_features(vecs, 3 * int(numpy.sum(mask)),
+                                       approx_dim)
+
+    results = []
+    for frame_skip, (path, cost) in zip(frame_skips,
+                                        sweep_frames(vecs, len(input_files),
+                                                     frame_skips, mode,
+                                                     skip_min, skip_max)):
+        logger.info("frame_skip %s: Kept %s / %s (%.1f %%) frames, path cost "
+                    "%.1f", frame_skip, len(path), len(input_files),
+                    100. * len(path) / len(input_files), cost)
+        results.append(([input_files[i] for i in path], cost))
+    return results
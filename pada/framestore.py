@@ -0,0 +1,360 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+__all__ = (
+    'COMPRESSIONS',
+    'export_frames',
+    'FrameStore',
+    'FrameStoreWriter',
+    'is_frame_store',
+    'remove_frame_store',
+    'write_chunk',
+)
+
+
+import glob
+import json
+import os
+
+import cv2
+import numpy
+
+from . import pipeline
+from .logging import logger
+from .timing import profiler
+
+
+INDEX_NAME = "frames.json"
+_CHUNK_GLOB = "chunk-*.bin"
+_INDEX_VERSION = 1
+
+# Ways of storing each frame: `'raw'` frames are the bare pixels, which can be
+# read straight out of a memory map, while `'png'` frames are losslessly
+# compressed.
+COMPRESSIONS = ('raw', 'png')
+
+DEFAULT_CHUNK_SIZE = 256
+
+
+def _chunk_name(first_name):
+    return "chunk-{}.bin".format(
+                       os.path.splitext(os.path.basename(first_name))[0])
+
+
+def _encode(im, compression):
+    if compression == 'raw':
+        return numpy.ascontiguousarray(im).tobytes()
+    ok, data = cv2.imencode('.png', im)
+    if not ok:
+        raise IOError("Could not encode frame")
+    return data.tobytes()
+
+
+def _read_index(path):
+    try:
+        with open(os.path.join(path, INDEX_NAME)) as f:
+            index = json.load(f)
+    except IOError:
+        return None
+    if index.get('version') != _INDEX_VERSION:
+        raise Exception("Frame store in {} is from an older version".format(
+                                                                        path))
+    return index
+
+
+def is_frame_store(path):
+    """
+    Return whether `path` holds a frame store.
+
+    """
+    return os.path.exists(os.path.join(path, INDEX_NAME))
+
+
+def remove_frame_store(path):
+    """
+    Delete the index and chunk files of the frame store in `path`, if any.
+
+    """
+    for fname in glob.glob(os.path.join(path, _CHUNK_GLOB)):
+        os.remove(fname)
+    if os.path.exists(os.path.join(path, INDEX_NAME)):
+        os.remove(os.path.join(path, INDEX_NAME))
+
+
+def write_chunk(path, frames, compression):
+    """
+    Write `(name, im)` pairs from the iterable `frames` into new chunk files in
+    `path`, starting a new chunk whenever the image shape changes.
+
+    Each image is encoded before the next is taken from `frames`, so the
+    images may share a buffer. Returns a list of `(chunk, entries)` pairs to
+    pass to :meth:`.FrameStoreWriter.add_chunk`.
+
+    """
+    chunks = []
+    f = None
+    try:
+        for name, im in frames:
+            if f is None or list(im.shape) != chunks[-1][0]['shape']:
+                if f is not None:
+                    f.close()
+                chunk = {'file': _chunk_name(name), 'shape': list(im.shape)}
+                chunks.append((chunk, []))
+                f = open(os.path.join(path, chunk['file']), 'wb')
+                offset = 0
+            with profiler.stage('encode'):
+                data = _encode(im, compression)
+                f.write(data)
+            chunks[-1][1].append([os.path.basename(name), offset, len(data)])
+            offset += len(data)
+    finally:
+        if f is not None:
+            f.close()
+    return chunks
+
+
+class FrameStoreWriter(object):
+    """
+    Append frames to the frame store in `path`, creating it if necessary.
+
+    A frame store keeps images of the same shape together in chunk files of
+    up to `chunk_size` frames, along with an index (`frames.json`) giving the
+    name, chunk and byte range of each frame. Frames are stored as given by
+    `compression`, which must be one of :data:`.COMPRESSIONS`. The index is
+    only written by :meth:`.close`.
+
+    :meth:`.write` and :meth:`.get_buffer` work in the same way as those of
+    :class:`.AsyncWriter`, so either can be used to write aligned images.
+
+    """
+    def __init__(self, path, compression='raw',
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        if compression not in COMPRESSIONS:
+            raise Exception("Unknown frame store compression {}".format(
+                                                                 compression))
+        index = _read_index(path)
+        if index is not None and index['compression'] != compression:
+            raise Exception("Frame store in {} uses {} compression".format(
+                                                  path, index['compression']))
+        self.path = path
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self._chunks = index['chunks'] if index is not None else []
+        self._frames = index['frames'] if index is not None else []
+        self._file = None
+        self._last = None
+
+    def _open_chunk(self, name, shape):
+        self._close_chunk()
+
+        # Carry on filling the last chunk if there is room for this frame.
+        if self._chunks and self._chunks[-1]['shape'] == list(shape):
+            last = len(self._chunks) - 1
+            entries = [e for e in self._frames if e[1] == last]
+            if entries and len(entries) < self.chunk_size:
+                self._file = open(os.path.join(self.path,
+                                               self._chunks[-1]['file']),
+                                  'r+b')
+                self._offset = entries[-1][2] + entries[-1][3]
+                self._file.seek(self._offset)
+                self._file.truncate()
+                self._count = len(entries)
+                return
+
+        self._chunks.append({'file': _chunk_name(name),
+                             'shape': list(shape)})
+        self._file = open(os.path.join(self.path, self._chunks[-1]['file']),
+                          'wb')
+        self._offset = 0
+        self._count = 0
+
+    def _close_chunk(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, fname, im):
+        """
+        Append `im` to the store under the base name of `fname`.
+
+        """
+        if (self._file is None or self._count == self.chunk_size or
+                self._chunks[-1]['shape'] != list(im.shape)):
+            self._open_chunk(fname, im.shape)
+        with profiler.stage('encode'):
+            data = _encode(im, self.compression)
+            self._file.write(data)
+        self._frames.append([os.path.basename(fname), len(self._chunks) - 1,
+                             self._offset, len(data)])
+        self._offset += len(data)
+        self._count += 1
+        self._last = im
+        logger.debug("Stored frame %s", fname)
+
+    def get_buffer(self):
+        """
+        Return the last image written, which may be reused, or `None`.
+
+        """
+        buf, self._last = self._last, None
+        return buf
+
+    def add_chunk(self, chunk, entries):
+        """
+        Add a chunk written by :func:`.write_chunk` to the store.
+
+        """
+        self._close_chunk()
+        self._chunks.append(chunk)
+        self._frames.extend([name, len(self._chunks) - 1, offset, nbytes]
+                                for name, offset, nbytes in entries)
+
+    def adopt(self, store, names, new_names):
+        """
+        Move the chunks holding the frames `names` of the :class:`.FrameStore`
+        `store` into this store, and add those frames as `new_names`.
+
+        """
+        self._close_chunk()
+        chunks = {}
+        for name, new_name in zip(names, new_names):
+            chunk, offset, nbytes = store.locate(name)
+            if chunk not in chunks:
+                fname = _chunk_name(new_name)
+                os.rename(os.path.join(store.path,
+                                       store.chunks[chunk]['file']),
+                          os.path.join(self.path, fname))
+                self._chunks.append({'file': fname,
+                                     'shape': store.chunks[chunk]['shape']})
+                chunks[chunk] = len(self._chunks) - 1
+            self._frames.append([os.path.basename(new_name), chunks[chunk],
+                                 offset, nbytes])
+
+    def close(self):
+        self._close_chunk()
+        tmp_path = os.path.join(self.path, "{}.tmp".format(INDEX_NAME))
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': _INDEX_VERSION,
+                       'compression': self.compression,
+                       'chunks': self._chunks,
+                       'frames': self._frames}, f)
+        os.rename(tmp_path, os.path.join(self.path, INDEX_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Leave the index as it was, so the partly written frames are not
+            # used.
+            self._close_chunk()
+
+
+class FrameStore(object):
+    """
+    Read frames from the frame store in `path`.
+
+    Frames are looked up by base name, and `names` lists the frames in order,
+    as the paths loose image files in `path` would have. Chunk files are
+    memory mapped, so frames are paged in as they are read, and `'raw'` frames
+    are returned as read-only views of the map.
+
+    """
+    def __init__(self, path):
+        index = _read_index(path)
+        if index is None:
+            raise IOError("No frame store in {}".format(path))
+        self.path = path
+        self.compression = index['compression']
+        self.chunks = index['chunks']
+        self.names = [os.path.join(path, name)
+                          for name, chunk, offset, nbytes in index['frames']]
+        self._frames = dict((name, (chunk, offset, nbytes))
+                                for name, chunk, offset, nbytes
+                                    in index['frames'])
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def locate(self, name):
+        """
+        Return the `(chunk, offset, nbytes)` of the frame `name`.
+
+        """
+        try:
+            return self._frames[os.path.basename(name)]
+        except KeyError:
+            raise IOError("No frame {} in {}".format(name, self.path))
+
+    def _map(self, chunk):
+        if chunk not in self._maps:
+            self._maps[chunk] = numpy.memmap(
+                           os.path.join(self.path, self.chunks[chunk]['file']),
+                           dtype=numpy.uint8, mode='r')
+        return self._maps[chunk]
+
+    def read(self, name, reduce=1):
+        """
+        Return the frame `name`, at 1/`reduce` of its width and height.
+
+        """
+        chunk, offset, nbytes = self.locate(name)
+        data = self._map(chunk)[offset:offset + nbytes]
+        if self.compression == 'raw':
+            im = data.reshape(self.chunks[chunk]['shape'])
+        else:
+            im = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        if reduce != 1:
+            im = cv2.resize(im, ((im.shape[1] + reduce - 1) // reduce,
+                                 (im.shape[0] + reduce - 1) // reduce),
+                            interpolation=cv2.INTER_AREA)
+        return im
+
+    def stamp(self, name):
+        """
+        Return a list which changes whenever frame `name` may have changed.
+
+        """
+        chunk, offset, nbytes = self.locate(name)
+        fname = os.path.join(self.path, self.chunks[chunk]['file'])
+        return [name, self.chunks[chunk]['file'], offset, nbytes,
+                os.stat(fname).st_mtime]
+
+
+def export_frames(store, names, threads=1, queue_depth=4):
+    """
+    Write each of the frames `names` of the :class:`.FrameStore` `store` to an
+    image file of that name, so that tools which need loose files can read
+    them.
+
+    """
+    with pipeline.AsyncWriter(threads, queue_depth) as writer:
+        for name in names:
+            # Wait for room in the writer's queue, but always read into a new
+            # image, since raw frames are views of the store.
+            writer.get_buffer()
+            with profiler.stage('decode'):
+                im = store.read(name)
+            writer.write(name, im)
+    logger.info("Exported %s frames from %s", len(names), store.path)
@@ -27,10 +27,14 @@ __all__ = (
 )
 
 
+import collections
+
 import cv2
-import dlib
 import numpy
 
+from .logging import logger
+from .timing import profiler
+
 
 class TooManyFaces(Exception):
     pass
@@ -41,20 +45,172 @@ class NoFaces(Exception):
 
 
 class LandmarkFinder(object):
-    def __init__(self, predictor_path):
-        self.detector = dlib.get_frontal_face_detector()
-        self.predictor = dlib.shape_predictor(str(predictor_path))
+    """
+    Find the 68 dlib facial landmarks in an image.
+
+    If `detect_scale` is less than 1, the face detector is run on a copy of
+    the image shrunk by that factor, and the resulting rectangle is scaled back
+    up before running the shape predictor on the full resolution image. If the
+    shrunk image does not contain exactly one face, detection falls back to
+    the full resolution image.
+
+    If `track` is set, the detector is first run on the region around the
+    face found in the previous image, padded by `track_padding` times the
+    face's size on each side. Only if this region does not contain exactly one
+    face is the whole image searched. The landmarks found therefore depend on
+    the order in which images are passed to :meth:`.get`. Callers which skip
+    images, for example because their landmarks were cached, should call
+    :meth:`.reset_tracking` so that the next image is searched in full rather
+    than near a face from further back.
+
+    Counts of tracking hits and misses, and of scaled detection fallbacks, are
+    kept in `stats`.
+
+    The detector and the shape predictor are only loaded when they are first
+    used, so commands which never look for landmarks do not pay for loading
+    the predictor file.
+
+    """
+    def __init__(self, predictor_path, detect_scale=1.0, track=False,
+                 track_padding=0.5):
+        self.predictor_path = predictor_path
+        self.detect_scale = detect_scale
+        self.track = track
+        self.track_padding = track_padding
+        self.stats = collections.Counter()
+        self._prev_rect = None
+        self._detector = None
+        self._predictor = None
+
+    def _load(self):
+        # dlib is imported here rather than at module level, so that code
+        # which never looks for faces (such as the benchmarks, which use a stub
+        # finder) does not need it installed.
+        import dlib
+        if self._predictor is None:
+            logger.debug("Loading predictor %s", self.predictor_path)
+            self._detector = dlib.get_frontal_face_detector()
+            self._predictor = dlib.shape_predictor(str(self.predictor_path))
+
+    @property
+    def detector(self):
+        self._load()
+        return self._detector
+
+    @property
+    def predictor(self):
+        self._load()
+        return self._predictor
+
+    def __getstate__(self):
+        # Pickle by path, so that processes which receive a landmark finder
+        # load the predictor themselves.
+        return self.get_settings()
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def reset_tracking(self):
+        """
+        Forget the face found in the previous image, so that the next image
+        is searched in full.
+
+        """
+        self._prev_rect = None
+
+    def get_settings(self):
+        """
+        Return a dict of the settings which affect the landmarks returned.
+
+        """
+        return {'predictor_path': self.predictor_path,
+                'detect_scale': self.detect_scale,
+                'track': self.track,
+                'track_padding': self.track_padding}
+
+    def log_stats(self, stats=None):
+        if stats is None:
+            stats = self.stats
+        if self.track:
+            logger.info("Face tracking: %s hits, %s misses",
+                        stats['track_hits'], stats['track_misses'])
+        if self.detect_scale < 1.0:
+            logger.info("Scaled detection: %s fallbacks to full resolution",
+                        stats['scale_fallbacks'])
+
+    def _detect_scaled(self, im):
+        import dlib
+        small_im = cv2.resize(im, (0, 0),
+                              fx=self.detect_scale, fy=self.detect_scale,
+                              interpolation=cv2.INTER_AREA)
+        with profiler.stage('detect'):
+            rects = self.detector(small_im, 1)
+        if len(rects) != 1:
+            return rects
+
+        sx = float(im.shape[1]) / small_im.shape[1]
+        sy = float(im.shape[0]) / small_im.shape[0]
+        r = rects[0]
+        return [dlib.rectangle(int(round(r.left() * sx)),
+                               int(round(r.top() * sy)),
+                               int(round(r.right() * sx)),
+                               int(round(r.bottom() * sy)))]
+
+    def _detect_tracked(self, im):
+        import dlib
+        r = self._prev_rect
+        pad_x = int(self.track_padding * r.width())
+        pad_y = int(self.track_padding * r.height())
+        left = max(0, r.left() - pad_x)
+        top = max(0, r.top() - pad_y)
+        right = min(im.shape[1], r.right() + pad_x)
+        bottom = min(im.shape[0], r.bottom() + pad_y)
+        if right <= left or bottom <= top:
+            return []
+
+        region = im[top:bottom, left:right]
+        if self.detect_scale < 1.0:
+            rects = self._detect_scaled(region)
+        else:
+            with profiler.stage('detect'):
+                rects = self.detector(region, 1)
+        return [dlib.rectangle(rect.left() + left, rect.top() + top,
+                               rect.right() + left, rect.bottom() + top)
+                    for rect in rects]
+
+    def _detect(self, im):
+        if self.track and self._prev_rect is not None:
+            rects = self._detect_tracked(im)
+            if len(rects) == 1:
+                self.stats['track_hits'] += 1
+                return rects
+            logger.debug("Found %s faces near previous face, searching whole "
+                         "image", len(rects))
+            self.stats['track_misses'] += 1
+
+        if self.detect_scale < 1.0:
+            rects = self._detect_scaled(im)
+            if len(rects) == 1:
+                return rects
+            logger.debug("Found %s faces in scaled image, falling back to "
+                         "full resolution", len(rects))
+            self.stats['scale_fallbacks'] += 1
+
+        with profiler.stage('detect'):
+            return self.detector(im, 1)
 
     def get(self, im):
-        rects = self.detector(im, 1)
+        rects = self._detect(im)
         
         if len(rects) > 1:
             raise TooManyFaces
         if len(rects) == 0:
             raise NoFaces
 
-        return numpy.matrix([[p.x, p.y]
-                                for p in self.predictor(im, rects[0]).parts()])
+        self._prev_rect = rects[0]
+        with profiler.stage('predict'):
+            shape = self.predictor(im, rects[0])
+        return numpy.matrix([[p.x, p.y] for p in shape.parts()])
 
 
 def draw_convex_hull(im, points, color):
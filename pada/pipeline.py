@@ -0,0 +1,177 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+__all__ = (
+    'AsyncWriter',
+    'prefetch',
+)
+
+
+import collections
+import itertools
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
+
+import cv2
+
+from .logging import logger
+from .timing import profiler
+
+
+def prefetch(func, items, threads, depth):
+    """
+    Yield `func(item)` for each of `items`, in order.
+
+    Up to `depth` results are computed ahead of the consumer, on a pool of
+    `threads` threads. If `threads` is 0 each result is computed in the
+    calling thread when it is requested.
+
+    OpenCV releases the GIL while decoding, so this keeps the disk busy while
+    the consumer is finding landmarks.
+
+    """
+    if threads < 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pool = ThreadPool(threads)
+    try:
+        items = iter(items)
+        pending = collections.deque(pool.apply_async(func, (item,))
+                                        for item in itertools.islice(
+                                                        items, max(depth, 1)))
+        while pending:
+            result = pending.popleft().get()
+            for item in itertools.islice(items, 1):
+                pending.append(pool.apply_async(func, (item,)))
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class AsyncWriter(object):
+    """
+    Write images to disk on background threads.
+
+    Images passed to :meth:`.write` are queued, and must not be modified
+    afterwards. Once an image has been written it is put on a free list, from
+    which :meth:`.get_buffer` hands it out again to be reused for a later
+    image. At most `threads + depth + 1` images are held by the writer, and
+    :meth:`.write` blocks while `depth` images are waiting to be written.
+
+    If `threads` is 0 images are written synchronously by :meth:`.write`.
+
+    Errors raised when writing an image are re-raised by the next call to
+    :meth:`.write` or :meth:`.close`.
+
+    """
+    def __init__(self, threads, depth):
+        self._queue = Queue.Queue(maxsize=max(depth, 1))
+        self._free = Queue.Queue()
+        self._limit = threads + depth + 1
+        self._allocated = 0
+        self._error = None
+        self._threads = [threading.Thread(target=self._run)
+                             for _ in range(threads)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _write(self, fname, im):
+        with profiler.stage('encode'):
+            cv2.imwrite(fname, im)
+        logger.debug("Wrote file %s", fname)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fname, im = item
+            try:
+                if self._error is None:
+                    self._write(fname, im)
+            except Exception as e:
+                self._error = e
+            self._free.put(im)
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def get_buffer(self):
+        """
+        Return an image which has been written and may be reused, or `None` if
+        the caller should allocate a new one.
+
+        Blocks if the limit on the number of images has been reached, until
+        one has been written.
+
+        """
+        try:
+            return self._free.get_nowait()
+        except Queue.Empty:
+            pass
+        if self._allocated < self._limit:
+            self._allocated += 1
+            return None
+        return self._free.get()
+
+    def write(self, fname, im):
+        """
+        Write `im` to `fname`.
+
+        """
+        self._check()
+        if self._threads:
+            self._queue.put((fname, im))
+        else:
+            self._write(fname, im)
+            self._free.put(im)
+
+    def close(self):
+        """
+        Wait for all queued images to be written.
+
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Let the original exception propagate.
+            try:
+                self.close()
+            except Exception:
+                pass
+        return False
@@ -0,0 +1,351 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+__all__ = (
+    'align_preview',
+    'aligned_path',
+    'make_proxies',
+    'preview_settings',
+    'replay_align',
+    'replay_filtered',
+)
+
+
+import json
+import os
+
+import cv2
+import numpy
+
+from . import align
+from . import decode
+from . import landmarks
+from . import pipeline
+from .logging import logger
+from .timing import profiler
+
+
+PREVIEW_NAME = "preview.json"
+_PROXY_INDEX_NAME = "proxies.json"
+_PREVIEW_VERSION = 1
+
+# Settings of `align_images` which change the decisions made by a preview.
+_SETTINGS = ('img_thresh', 'dedup_mode', 'hash_thresh', 'dedup_reduce',
+             'reference', 'out_width', 'out_height', 'crop')
+
+
+def _proxy_dir(preview_path):
+    return os.path.join(preview_path, "proxies")
+
+
+def aligned_path(preview_path):
+    """
+    Return the directory that preview aligned images are written to.
+
+    """
+    return os.path.join(preview_path, "aligned")
+
+
+def preview_settings(preview_path, scale, filtered_files, feature_store,
+                     erode_amount):
+    """
+    Return the paths and settings `framedrop` should use in preview mode, as a
+    dict with keys `aligned_path`, `filtered_files`, `feature_store` and
+    `erode_amount`.
+
+    The filtered file list and the feature store are written alongside the
+    preview, and `erode_amount` is shrunk to match the proxy frames.
+
+    """
+    return {
+        'aligned_path': aligned_path(preview_path),
+        'filtered_files': os.path.join(preview_path,
+                                       os.path.basename(filtered_files)),
+        'feature_store': (None if feature_store is None else
+                          os.path.join(preview_path,
+                                       os.path.basename(feature_store))),
+        'erode_amount': max(1, erode_amount // scale) | 1,
+    }
+
+
+def _write_proxy(args):
+    n, proxy_name, scale = args
+    with profiler.stage('decode.reduced'):
+        im = decode.imread(n, scale)
+    with profiler.stage('encode'):
+        cv2.imwrite(proxy_name, im)
+
+
+def make_proxies(input_files, proxy_path, scale, threads=1, queue_depth=4):
+    """
+    Write a copy of each of `input_files` at 1/`scale` resolution into
+    `proxy_path`, and return the proxy file names in the same order.
+
+    Proxies are lossless, and are named by their index in `input_files`. An
+    index of the inputs they were made from is kept, so that proxies are only
+    rewritten when their input or `scale` changes.
+
+    """
+    index_fname = os.path.join(proxy_path, _PROXY_INDEX_NAME)
+    try:
+        with open(index_fname) as f:
+            index = json.load(f)
+    except IOError:
+        index = {'scale': None, 'inputs': []}
+    if index['scale'] != scale:
+        index = {'scale': scale, 'inputs': []}
+    if not os.path.isdir(proxy_path):
+        os.makedirs(proxy_path)
+
+    old_inputs = index['inputs']
+    proxies = []
+    todo = []
+    stamps = []
+    for i, n in enumerate(input_files):
+        proxy_name = os.path.join(proxy_path, "{:08d}.png".format(i))
+        stamp = align._file_stamp(n)
+        if (i >= len(old_inputs) or old_inputs[i] != stamp or
+                not os.path.exists(proxy_name)):
+            todo.append((n, proxy_name, scale))
+        proxies.append(proxy_name)
+        stamps.append(stamp)
+    for i in range(len(input_files), len(old_inputs)):
+        proxy_name = os.path.join(proxy_path, "{:08d}.png".format(i))
+        if os.path.exists(proxy_name):
+            os.remove(proxy_name)
+
+    logger.info("Writing %s / %s proxy images at 1/%s resolution",
+                len(todo), len(input_files), scale)
+    for _ in pipeline.prefetch(_write_proxy, todo, threads, queue_depth):
+        pass
+
+    with open(index_fname, 'w') as f:
+        json.dump({'scale': scale, 'inputs': stamps}, f)
+    return proxies
+
+
+class _Recorder(object):
+    """
+    Landmark cache which records every result it returns or is given, and
+    passes everything through to an optional :class:`.LandmarkCache`.
+
+    """
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.results = {}
+
+    def lookup(self, fname, stamp=None):
+        result = None
+        if self.cache is not None:
+            result = self.cache.lookup(fname, stamp)
+        if result is not None:
+            self.results[fname] = result
+        return result
+
+    def store(self, fname, result, stamp=None):
+        self.results[fname] = result
+        if self.cache is not None:
+            self.cache.store(fname, result, stamp)
+
+    def get(self, fname, im, landmark_finder):
+        result = self.lookup(fname)
+        if result is None:
+            try:
+                result = landmark_finder.get(im)
+            except (landmarks.NoFaces, landmarks.TooManyFaces) as e:
+                result = type(e)
+            self.store(fname, result)
+        else:
+            landmark_finder.reset_tracking()
+
+        if isinstance(result, type):
+            raise result
+        return result
+
+    def save(self):
+        if self.cache is not None:
+            self.cache.save()
+
+
+class _Replayer(object):
+    """
+    Landmark cache holding the landmarks recorded by a preview, for the
+    images it kept.
+
+    """
+    def __init__(self, results):
+        self.results = results
+
+    def lookup(self, fname, stamp=None):
+        return self.results.get(fname)
+
+    def store(self, fname, result, stamp=None):
+        pass
+
+    def get(self, fname, im, landmark_finder):
+        return self.results[fname]
+
+    def save(self):
+        pass
+
+
+def _check_settings(align_kwargs):
+    if align_kwargs.get('shard') is not None:
+        raise Exception("Previews and replays cannot be sharded")
+    return dict((k, align_kwargs.get(k)) for k in _SETTINGS)
+
+
+def align_preview(input_files, preview_path, scale, threads=1, **align_kwargs):
+    """
+    Run :func:`.align_images` on proxies of `input_files` at 1/`scale`
+    resolution, writing the draft aligned images to :func:`.aligned_path`.
+
+    Duplicate and face detection, and the choice of reference, are all made
+    by the usual code on the proxy images. `img_thresh`, `out_width` and
+    `out_height` are scaled to match the proxies. The input images that were
+    kept, along with their landmarks scaled back up to full resolution, are
+    written to `preview_path` so that :func:`.replay_align` can align the full
+    resolution images without finding them again.
+
+    :param threads:
+
+        Number of threads writing proxy images.
+
+    The remaining keyword arguments are passed to :func:`.align_images`,
+    except that `out_path` is replaced. Incremental runs and reference files
+    are not supported.
+
+    Returns the number of images which were aligned.
+
+    """
+    settings = _check_settings(align_kwargs)
+    if align_kwargs.get('reference_file') is not None:
+        raise Exception("A reference file cannot be used with a preview")
+
+    proxies = make_proxies(input_files, _proxy_dir(preview_path), scale,
+                           threads, align_kwargs.get('queue_depth', 4))
+    inputs = dict(zip(proxies, input_files))
+
+    kwargs = dict(align_kwargs)
+    recorder = _Recorder(kwargs.get('cache'))
+    kwargs.update(out_path=aligned_path(preview_path), cache=recorder,
+                  incremental=False)
+    if kwargs.get('img_thresh') is not None:
+        kwargs['img_thresh'] = kwargs['img_thresh'] / float(scale)
+    for k in ('out_width', 'out_height'):
+        if kwargs.get(k) is not None:
+            kwargs[k] = max(1, int(round(kwargs[k] / float(scale))))
+    count = align.align_images(proxies, **kwargs)
+
+    with open(os.path.join(aligned_path(preview_path),
+                           align.MANIFEST_NAME)) as f:
+        outputs = json.load(f)['outputs']
+    # Proxy pixel centres are `scale` input pixels apart.
+    kept = [[inputs[n],
+             ((numpy.asarray(recorder.results[n]) + 0.5) * scale -
+              0.5).tolist()]
+                for n in outputs]
+    d = {
+        'version': _PREVIEW_VERSION,
+        'scale': scale,
+        'settings': settings,
+        'inputs': [align._file_stamp(n) for n in input_files],
+        'outputs': kept,
+    }
+    with open(os.path.join(preview_path, PREVIEW_NAME), 'w') as f:
+        json.dump(d, f)
+    logger.info("Wrote preview of %s images to %s", count,
+                aligned_path(preview_path))
+    return count
+
+
+def _read_preview(preview_path):
+    try:
+        with open(os.path.join(preview_path, PREVIEW_NAME)) as f:
+            d = json.load(f)
+    except IOError:
+        raise Exception("No preview in {}. Run with --preview first.".format(
+                                                                preview_path))
+    if d.get('version') != _PREVIEW_VERSION:
+        raise Exception("Preview in {} is from an older version".format(
+                                                                preview_path))
+    return d
+
+
+def replay_align(input_files, preview_path, **align_kwargs):
+    """
+    Align `input_files` at full resolution, replaying the decisions made by
+    :func:`.align_preview`.
+
+    Only the images the preview kept are read, and their landmarks are taken
+    from the preview, so no duplicate or face detection is done. The aligned
+    images correspond one to one with the preview's aligned images.
+
+    Keyword arguments are passed to :func:`.align_images`. The input images
+    must not have changed since the preview.
+
+    Returns the number of images which were aligned.
+
+    """
+    settings = _check_settings(align_kwargs)
+    d = _read_preview(preview_path)
+    if d['inputs'] != [align._file_stamp(n) for n in input_files]:
+        raise Exception("Input images have changed since the preview. Run "
+                        "with --preview again.")
+    if d['settings'] != settings:
+        logger.warn("Align settings have changed since the preview")
+
+    kwargs = dict(align_kwargs)
+    replayer = _Replayer(dict((n, numpy.matrix(lms))
+                                  for n, lms in d['outputs']))
+    kwargs.update(cache=replayer, img_thresh=None, dedup_mode='l2',
+                  incremental=False, reference_file=None)
+    logger.info("Replaying preview of %s images", len(d['outputs']))
+    return align.align_images([n for n, lms in d['outputs']], **kwargs)
+
+
+def replay_filtered(preview_path, filtered_files, out_path, out_extension):
+    """
+    Return the aligned images in `out_path` which correspond to the frames
+    selected by a preview `framedrop`, whose file list was written to
+    `filtered_files`.
+
+    The images in `out_path` must have been written by :func:`.replay_align`
+    from the same preview.
+
+    """
+    d = _read_preview(preview_path)
+    try:
+        with open(os.path.join(out_path, align.MANIFEST_NAME)) as f:
+            outputs = json.load(f)['outputs']
+    except IOError:
+        outputs = None
+    if outputs != [n for n, lms in d['outputs']]:
+        raise Exception("Images in {} were not aligned from the preview. Run "
+                        "align with --replay first.".format(out_path))
+
+    with open(filtered_files) as f:
+        names = [line.strip() for line in f if line.strip()]
+    return [os.path.join(out_path,
+                         "{}.{}".format(
+                             os.path.splitext(os.path.basename(n))[0],
+                             out_extension))
+                for n in names]
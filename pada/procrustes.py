@@ -0,0 +1,138 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+__all__ = (
+    'batch_procrustes',
+    'generalized_procrustes',
+)
+
+
+import numpy
+
+from .logging import logger
+from .timing import profiler
+
+
+def _as_points(points):
+    return numpy.asarray(points, dtype=numpy.float64)
+
+
+def batch_procrustes(points1, points2):
+    """
+    Solve :func:`.orthogonal_procrustes` for many sets of points at once.
+
+    :param points1:
+
+        An `(N, K, 2)` array of points.
+
+    :param points2:
+
+        An `(N, K, 2)` array of points.
+
+    Either argument may instead be a single `(K, 2)` set of points, which is
+    used for every problem.
+
+    Returns an `(N, 3, 3)` array of affine transformations (`N` is 1 if both
+    arguments are single sets of points), where the i'th minimizes:
+
+        sum ||s*R*points1[i, k] + T - points2[i, k]||^2
+
+    """
+    points1 = _as_points(points1)
+    points2 = _as_points(points2)
+    points1, points2 = numpy.broadcast_arrays(points1, points2)
+    points1 = points1.reshape((-1,) + points1.shape[-2:])
+    points2 = points2.reshape((-1,) + points2.shape[-2:])
+
+    c1 = points1.mean(axis=1, keepdims=True)
+    c2 = points2.mean(axis=1, keepdims=True)
+    points1 = points1 - c1
+    points2 = points2 - c2
+
+    s1 = points1.std(axis=(1, 2))
+    s2 = points2.std(axis=(1, 2))
+
+    # As in `orthogonal_procrustes`, but with the SVDs of all the (2, 2)
+    # covariance matrices computed in one call. The scale factors are applied
+    # after the SVD, as they do not change U or Vt.
+    U, S, Vt = numpy.linalg.svd(numpy.einsum('nki,nkj->nij',
+                                             points1, points2))
+    R = numpy.matmul(U, Vt).transpose(0, 2, 1)
+
+    sR = (s2 / s1)[:, numpy.newaxis, numpy.newaxis] * R
+    M = numpy.zeros((len(points2), 3, 3))
+    M[:, :2, :2] = sR
+    M[:, :2, 2] = c2[:, 0] - numpy.einsum('nij,nj->ni', sR, c1[:, 0])
+    M[:, 2, 2] = 1.
+    return M
+
+
+def _transform(M, points):
+    return (numpy.einsum('nij,nkj->nki', M[:, :2, :2], points) +
+            M[:, numpy.newaxis, :2, 2])
+
+
+@profiler.timed('procrustes')
+def generalized_procrustes(points, max_iterations=20, tol=1e-3):
+    """
+    Find a mean shape for a set of landmarks, by generalized Procrustes
+    analysis.
+
+    The mean is initialised to the average of the landmarks as given. Each
+    iteration aligns every set of landmarks onto the mean, and replaces the
+    mean with the average of the aligned landmarks. The mean is kept at the
+    position and size of the initial average, so that it remains a sensible
+    place to put the face in the output images.
+
+    :param points:
+
+        `(N, K, 2)` array of landmarks.
+
+    :param max_iterations:
+
+        Maximum number of iterations.
+
+    :param tol:
+
+        Iteration stops once no point of the mean moves by more than this.
+
+    Returns a tuple `(mean, M)` where `mean` is the `(K, 2)` mean shape, and
+    `M` is as returned by :func:`.batch_procrustes` for the mean and `points`.
+
+    """
+    points = _as_points(points)
+    mean = points.mean(axis=0)
+    center = mean.mean(axis=0)
+    scale = mean.std()
+
+    for i in range(max_iterations):
+        aligned = _transform(batch_procrustes(points, mean), points)
+        new_mean = aligned.mean(axis=0)
+        new_mean -= new_mean.mean(axis=0)
+        new_mean *= scale / new_mean.std()
+        new_mean += center
+        delta = numpy.max(numpy.abs(new_mean - mean))
+        mean = new_mean
+        if delta <= tol:
+            break
+    logger.info("Found mean face after %s iterations", i + 1)
+
+    return mean, batch_procrustes(mean, points)
@@ -0,0 +1,215 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+__all__ = (
+    'render_video',
+)
+
+
+import os
+import subprocess
+import tempfile
+
+import cv2
+import numpy
+import numpy.lib.format
+
+from . import align
+from . import dedup
+from . import features
+from . import framedrop
+from .logging import logger
+from .timing import profiler
+
+
+def _mask_rect(mask):
+    ys, xs = numpy.nonzero(mask)
+    return xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+
+
+def _warp_region(im, M, rect):
+    """
+    Warp only the region `rect` of the aligned image.
+
+    """
+    x0, y0, x1, y1 = rect
+    T = numpy.matrix([[1., 0., x0],
+                      [0., 1., y0],
+                      [0., 0., 1.]])
+    return align.warp_im(im, M * T, (y1 - y0, x1 - x0, im.shape[2]))
+
+
+class _FFmpegEncoder(object):
+    def __init__(self, out_fname, size, fps):
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+               '-s', '{}x{}'.format(*size), '-r', str(fps), '-i', '-',
+               '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+               '-c:v', 'libx264', '-crf', '24', '-pix_fmt', 'yuv420p',
+               out_fname]
+        logger.debug("Running %s", " ".join(cmd))
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, im):
+        self._proc.stdin.write(im.tobytes())
+
+    def close(self):
+        self._proc.stdin.close()
+        if self._proc.wait() != 0:
+            raise Exception("ffmpeg exited with status {}".format(
+                                                       self._proc.returncode))
+
+
+class _OpenCVEncoder(object):
+    def __init__(self, out_fname, size, fps):
+        self._writer = cv2.VideoWriter(out_fname,
+                                       cv2.VideoWriter_fourcc(*'mp4v'),
+                                       fps, size)
+        if not self._writer.isOpened():
+            raise Exception("Could not open {} for writing".format(out_fname))
+
+    def write(self, im):
+        self._writer.write(im)
+
+    def close(self):
+        self._writer.release()
+
+
+_ENCODERS = {
+    'ffmpeg': _FFmpegEncoder,
+    'opencv': _OpenCVEncoder,
+}
+
+
+def render_video(input_files, out_fname, landmark_finder, frame_skip,
+                 erode_amount, img_thresh=0.0, cache=None, dedup_mode='l2',
+                 hash_thresh=4, mode='layer', skip_min=None, skip_max=None,
+                 fps=30, encoder='ffmpeg', out_width=None, out_height=None,
+                 crop=None, dedup_reduce=1):
+    """
+    Align, filter and encode a set of images straight into a video.
+
+    This is equivalent to running :func:`.align_images`,
+    :func:`.filter_files` and then encoding the filtered files, except that no
+    aligned images are written to disk. In a first pass the landmarks of each
+    input image are found, and the masked face region (which is all that
+    frame selection looks at) is warped and kept in a temporary feature file.
+    Once frames are selected only those frames are fully warped, and they are
+    piped directly into the encoder.
+
+    :param out_fname:
+
+        Video file to write.
+
+    :param fps:
+
+        Frame rate of the output video.
+
+    :param encoder:
+
+        `'ffmpeg'` to pipe raw frames into an `ffmpeg` process, or `'opencv'`
+        to use `cv2.VideoWriter`.
+
+    The remaining parameters are as for :func:`.align_images` and
+    :func:`.filter_files`. The face mask used for frame selection is taken from
+    the reference landmarks, rather than from landmarks detected in the first
+    aligned image.
+
+    """
+    input_files = list(input_files)
+    if dedup_mode == 'hash':
+        dups = dedup.find_duplicates(
+                          input_files, hash_thresh,
+                          is_duplicate=align.hash_duplicate_check(img_thresh))
+        input_files = [n for n in input_files if n not in dups]
+        img_thresh = None
+
+    fd, feature_path = tempfile.mkstemp(suffix='.npy')
+    os.close(fd)
+    try:
+        # First pass: Find landmarks and colour of each frame, and the masked
+        # pixels of the aligned frame.
+        selected = []
+        ref_landmarks = None
+        ref_color = None
+        vecs = None
+        ims_and_landmarks = align.get_ims_and_landmarks(
+                                 align.read_ims(input_files, img_thresh,
+                                                dedup_reduce=dedup_reduce),
+                                 landmark_finder, cache)
+        for n, im, lms in ims_and_landmarks:
+            color = align.face_color(im, lms)
+            if ref_landmarks is None:
+                ref_landmarks = lms
+                ref_color = color
+                A, frame_shape = align.output_transform(
+                                             lms, im.shape, width=out_width,
+                                             height=out_height, crop=crop)
+                if A is None:
+                    A, frame_shape = numpy.identity(3), im.shape
+                # The face mask is drawn in output image coordinates.
+                mask_lms = align.output_landmarks(lms, A)
+                mask = framedrop.eroded_face_mask(
+                                    frame_shape,
+                                    numpy.rint(mask_lms).astype(numpy.int32),
+                                    erode_amount)
+                rect = _mask_rect(mask)
+                mask = mask[rect[1]:rect[3], rect[0]:rect[2]]
+                vecs = numpy.lib.format.open_memmap(
+                               feature_path, mode='w+', dtype=numpy.uint8,
+                               shape=(len(input_files), 3 * int(mask.sum())))
+
+            M = numpy.dot(align.orthogonal_procrustes(ref_landmarks, lms), A)
+            region = align.correct_color(_warp_region(im, M, rect),
+                                         ref_color, color)
+            vecs[len(selected)] = features.masked_vector(region, mask)
+            selected.append((n, lms, color))
+        if cache is not None:
+            cache.save()
+
+        if not selected:
+            raise Exception("No frames with a face to render")
+
+        path = framedrop.select_frames(vecs[:len(selected)], len(selected),
+                                       frame_skip, mode, skip_min, skip_max)
+        logger.info("Kept %s / %s (%s %%) frames",
+                    len(path), len(selected),
+                    100. * len(path) / len(selected))
+        del vecs
+    finally:
+        os.remove(feature_path)
+
+    # Second pass: Warp the selected frames and stream them to the encoder.
+    enc = _ENCODERS[encoder](out_fname, (frame_shape[1], frame_shape[0]), fps)
+    buf = None
+    try:
+        for i in path:
+            n, lms, color = selected[i]
+            with profiler.stage('decode'):
+                im = cv2.imread(n)
+            M = numpy.dot(align.orthogonal_procrustes(ref_landmarks, lms), A)
+            buf = align.warp_im(im, M, frame_shape, out=buf)
+            align.correct_color(buf, ref_color, color)
+            with profiler.stage('encode'):
+                enc.write(buf)
+    finally:
+        enc.close()
+    logger.info("Wrote %s", out_fname)
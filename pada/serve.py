@@ -0,0 +1,211 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+__all__ = (
+    'serve',
+)
+
+
+import errno
+import glob
+import json
+import os
+import select
+import socket
+import time
+
+from . import align
+from .logging import logger
+
+
+# Seconds to wait for a client to send its request, so that a client which
+# sends nothing cannot stop the server from polling.
+_REQUEST_TIMEOUT = 5.0
+
+
+def _snapshot(input_glob):
+    snapshot = []
+    for n in sorted(glob.glob(input_glob)):
+        try:
+            st = os.stat(n)
+        except OSError:
+            continue
+        snapshot.append((n, st.st_size, st.st_mtime))
+    return snapshot
+
+
+class _Server(object):
+    def __init__(self, input_glob, align_kwargs, socket_path):
+        self.input_glob = input_glob
+        self.align_kwargs = align_kwargs
+        self.socket_path = socket_path
+        self.sock = None
+        self._last_seen = None
+        self._last_aligned = None
+        self._last_failed = None
+
+    def open(self):
+        if self.socket_path is None:
+            return
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.socket_path)
+        self.sock.listen(5)
+        logger.info("Listening on %s", self.socket_path)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            os.remove(self.socket_path)
+            self.sock = None
+
+    def align(self, snapshot):
+        """
+        Align any new images in `snapshot`, and return the number of images
+        aligned.
+
+        """
+        count = align.align_images(input_files=[n for n, _, _ in snapshot],
+                                   **self.align_kwargs)
+        self._last_aligned = snapshot
+        return count
+
+    def poll(self):
+        """
+        Align new images once the set of input files has stopped changing.
+
+        Images are only aligned once two consecutive polls see the same
+        files, sizes and modification times, so that photos which are still
+        being copied in are not read.
+
+        If aligning fails, for example because an image cannot be read, the
+        error is logged and the same set of files is not tried again until it
+        changes.
+
+        """
+        snapshot = _snapshot(self.input_glob)
+        stable = (snapshot == self._last_seen)
+        self._last_seen = snapshot
+        if (stable and snapshot != self._last_aligned and
+                snapshot != self._last_failed):
+            try:
+                self.align(snapshot)
+            except Exception:
+                logger.exception("Failed to align images")
+                self._last_failed = snapshot
+
+    def handle(self, conn):
+        """
+        Handle one request on the socket.
+
+        The request is a single line. `align` aligns any new images straight
+        away, and `quit` stops the server. The response is a line of JSON,
+        holding an `error` message if the request failed. Clients which do not
+        send a request within `_REQUEST_TIMEOUT` seconds are dropped.
+
+        """
+        conn.settimeout(_REQUEST_TIMEOUT)
+        f = conn.makefile('rw')
+        try:
+            try:
+                request = f.readline().strip()
+            except socket.timeout:
+                logger.warn("Timed out waiting for a request")
+                return True
+            if request == 'align':
+                start = time.time()
+                try:
+                    count = self.align(_snapshot(self.input_glob))
+                except Exception as e:
+                    logger.exception("Failed to align images")
+                    response = {'error': "{}: {}".format(type(e).__name__,
+                                                         e)}
+                else:
+                    response = {'aligned': count,
+                                'seconds': time.time() - start}
+            elif request == 'quit':
+                response = {'quit': True}
+            else:
+                response = {'error': "Unknown request {!r}".format(request)}
+            try:
+                f.write(json.dumps(response) + "\n")
+                f.flush()
+            except socket.error as e:
+                if e.errno != errno.EPIPE:
+                    raise
+        finally:
+            f.close()
+            conn.close()
+        return request != 'quit'
+
+
+def serve(input_glob, poll_interval=2.0, socket_path=None, **align_kwargs):
+    """
+    Keep aligning images as they are added to `input_glob`.
+
+    The landmark finder (and landmark cache) passed in `align_kwargs` stay
+    loaded between runs, so each new photo only costs the time to align it.
+    Each run is an incremental run of :func:`.align_images`, which carries on
+    from the reference face and output numbering of the previous run.
+
+    :param input_glob:
+
+        Glob of the input images, which is polled every `poll_interval`
+        seconds.
+
+    :param socket_path:
+
+        Optional path of a Unix socket to listen on. Clients send a line
+        holding `align`, to align new images without waiting for the next
+        poll, or `quit`, to stop the server. Each gets a line of JSON in
+        response. Clients which send nothing are dropped after a few seconds.
+
+    The remaining arguments are passed to :func:`.align_images`. Images are
+    aligned in this process, so `jobs` is always 1, and `incremental` is always
+    set.
+
+    """
+    align_kwargs['jobs'] = 1
+    align_kwargs['incremental'] = True
+    server = _Server(input_glob, align_kwargs, socket_path)
+    server.open()
+    logger.info("Watching %s", input_glob)
+    try:
+        running = True
+        next_poll = time.time()
+        while running:
+            timeout = max(0., next_poll - time.time())
+            if server.sock is not None:
+                readable, _, _ = select.select([server.sock], [], [], timeout)
+            else:
+                time.sleep(timeout)
+                readable = []
+            if readable:
+                conn, _ = server.sock.accept()
+                running = server.handle(conn)
+            if time.time() >= next_poll:
+                server.poll()
+                next_poll = time.time() + poll_interval
+    except KeyboardInterrupt:
+        logger.info("Stopping")
+    finally:
+        server.close()
@@ -0,0 +1,162 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+__all__ = (
+    'Profiler',
+    'profiler',
+)
+
+
+import functools
+import json
+import os
+import threading
+import timeit
+
+import numpy
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        self._start = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = timeit.default_timer()
+        self._profiler.record(self._name, self._start, end - self._start)
+        return False
+
+
+class Profiler(object):
+    """
+    Collects the time spent in each named stage of processing.
+
+    Code to be timed is wrapped in ``with profiler.stage(name):``. When the
+    profiler is disabled (the default) this returns a shared no-op context
+    manager, so the overhead is a single method call.
+
+    """
+    def __init__(self):
+        self.enabled = False
+        self._events = []
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def timed(self, name):
+        """
+        Decorator which times each call of the decorated function as stage
+        `name`.
+
+        """
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, start, duration):
+        self._events.append((name, start, duration, os.getpid(),
+                             threading.current_thread().ident))
+
+    def drain(self):
+        """
+        Return and clear the recorded events. Used to pass events from worker
+        processes back to the parent.
+
+        """
+        events, self._events = self._events, []
+        return events
+
+    def merge(self, events):
+        self._events.extend(events)
+
+    def durations(self):
+        """
+        Return a dict mapping each stage name to an array of its durations.
+
+        """
+        d = {}
+        for name, start, duration, pid, tid in self._events:
+            d.setdefault(name, []).append(duration)
+        return {name: numpy.array(v) for name, v in d.items()}
+
+    def summary(self):
+        """
+        Return a table of the count, total, mean and percentile durations of
+        each stage, as a string.
+
+        """
+        durations = self.durations()
+        grand_total = sum(v.sum() for v in durations.values()) or 1.
+        lines = ["{:<22} {:>8} {:>10} {:>6} {:>9} {:>9} {:>9} {:>9}".format(
+                     "stage", "count", "total s", "%", "mean ms", "p50 ms",
+                     "p90 ms", "p99 ms")]
+        for name, v in sorted(durations.items(), key=lambda x: -x[1].sum()):
+            p50, p90, p99 = numpy.percentile(v, [50, 90, 99]) * 1000.
+            lines.append(
+                "{:<22} {:>8} {:>10.3f} {:>6.1f} {:>9.2f} {:>9.2f} {:>9.2f} "
+                "{:>9.2f}".format(name, len(v), v.sum(),
+                                  100. * v.sum() / grand_total,
+                                  v.mean() * 1000., p50, p90, p99))
+        return "\n".join(lines)
+
+    def write_trace(self, fname):
+        """
+        Write the recorded events to `fname` in the Chrome trace event format,
+        along with the per-stage summary statistics.
+
+        """
+        events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                   'ts': start * 1e6, 'dur': duration * 1e6}
+                      for name, start, duration, pid, tid in self._events]
+        stages = {name: {'count': len(v),
+                         'total': float(v.sum()),
+                         'mean': float(v.mean()),
+                         'p50': float(numpy.percentile(v, 50)),
+                         'p90': float(numpy.percentile(v, 90)),
+                         'p99': float(numpy.percentile(v, 99))}
+                      for name, v in self.durations().items()}
+        with open(fname, 'w') as f:
+            json.dump({'traceEvents': events, 'stages': stages}, f)
+
+
+# Profiler used throughout `pada`. It is enabled by `pada.py --profile`.
+profiler = Profiler()